@@ -0,0 +1,222 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+from datetime import datetime, timezone
+
+import main
+import offline
+
+# Offline benchmark for the daily pipeline: synthetic candles and RSS, a fake model and an
+# in-memory worksheet stand in for Yahoo, Google News, Gemini and Sheets.
+#
+#   python bench.py                          # 10, 500 and 5000 tickers
+#   python bench.py --sizes 10,500 --compare reports/bench_prev.json
+#   python bench.py --sizes "" --import-budget 0.2   # only the cold-import check
+
+
+def measure(fn, memory=True):
+    t0 = time.perf_counter()
+    out = fn()
+    res = {"seconds": round(time.perf_counter() - t0, 4)}
+    if memory:
+        tracemalloc.start()
+        fn()
+        res["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+        tracemalloc.stop()
+    return out, res
+
+def bench_config(tickers, work_dir, charts=True):
+    config = main.load_config(os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.yml"))
+    config.update({
+        "offline": True,
+        "skip_if_weekend": False,
+        "tickers": tickers,
+        "charts": {"enable": charts, "max_workers": 4},
+    })
+    news = dict(config.get("news", {}))
+    news.update({"rate_per_sec": 0, "cache": {"dir": os.path.join(work_dir, "news_cache")}})
+    config["news"] = news
+    config["candles"] = dict(config.get("candles", {}), store_dir=os.path.join(work_dir, "candles"))
+    config["llm_cache"] = dict(config.get("llm_cache", {}), dir=os.path.join(work_dir, "llm_cache"))
+    config["indicators"] = dict(config.get("indicators", {}), state_dir=os.path.join(work_dir, "indicators"))
+    return config
+
+def bench_universe(n, chart_sample=20, memory=True, pipeline_charts_max=50):
+    tickers = [f"SYN{i:04d}" for i in range(n)]
+    config = bench_config(tickers, tempfile.mkdtemp(prefix="bench-"), charts=n <= pipeline_charts_max)
+    lookback = int(config.get("lookback_days", 260))
+    frames = {t: offline.synthetic_candles(t, bars=int(lookback * 0.96)) for t in tickers}
+    for s in (config.get("indices") or []) + (config.get("commodities") or []) + (config.get("fx") or []):
+        frames[s] = offline.synthetic_candles(s, bars=int(lookback * 0.96))
+    stages = {}
+
+    _, stages["build_features"] = measure(lambda: [main.build_features(t, frames[t]) for t in tickers], memory)
+    fmap, stages["build_features_panel"] = measure(lambda: main.build_features_panel(frames, list(frames)), memory)
+    features = [fmap[t] for t in tickers if t in fmap]
+    overview = {k: main.to_overview_block(config.get(k), fmap) for k in ("indices", "commodities", "fx")}
+    _, stages["screen_top_k"] = measure(
+        lambda: main.screen_top_k(fmap.select(tickers), frames, config.get("screen", {})), memory)
+    factors = [it["ticker"] for arr in overview.values() for it in arr]
+    _, stages["cross_asset"] = measure(lambda: main.cross_asset_columns(frames, tickers, factors), memory)
+
+    session = offline.FakeNewsSession()
+    queries = {t: t for t in tickers}
+    news_cfg = dict(config["news"], cache={"enable": False})
+    news_map, stages["fetch_news_map"] = measure(
+        lambda: main.fetch_news_map(queries, news_cfg, session=session), memory)
+
+    _, stages["build_ai_prompt"] = measure(lambda: main.build_ai_prompt(config, overview, features, news_map), memory)
+    ai_json, stages["call_gemini_sharded"] = measure(
+        lambda: main.call_gemini_sharded(config, overview, features, news_map, model=offline.FakeModel()), memory)
+    _, stages["render_report"] = measure(
+        lambda: main.render_report("2000-01-01", overview, features, ai_json, news_map), memory)
+
+    sample = tickers[:chart_sample]
+    chart_dir = tempfile.mkdtemp(prefix="bench-charts-")
+    _, res = measure(lambda: [main.plot_stock(t, frames[t], os.path.join(chart_dir, f"{t}.png")) for t in sample], False)
+    res["charts"] = len(sample)
+    res["per_chart"] = round(res["seconds"] / max(len(sample), 1), 4)
+    res["extrapolated_seconds"] = round(res["per_chart"] * n, 2)
+    stages["plot_stock"] = res
+
+    _, stages["export_to_sheet"] = measure(
+        lambda: main.export_to_sheet(offline.FakeWorksheet(), "2000-01-01", features, ai_json), memory)
+
+    def pipeline():
+        cwd = os.getcwd()
+        os.chdir(tempfile.mkdtemp(prefix="bench-run-"))
+        try:
+            main.main(config)
+        finally:
+            os.chdir(cwd)
+    _, res = measure(pipeline, memory=False)
+    res["charts"] = bool(config["charts"]["enable"])
+    if memory:
+        res.update(pipeline_peak_memory(tickers, charts=res["charts"]))
+    stages["main"] = res
+    return {"tickers": n, "stages": stages}
+
+PIPELINE_CHILD = """
+import json, os, resource, sys
+import main
+with open(sys.argv[1], encoding="utf-8") as f:
+    config = json.load(f)
+os.chdir(sys.argv[2])
+main.main(config)
+scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is bytes on macOS, KiB on Linux
+print("BENCH_PEAK_RSS", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20)
+"""
+
+def pipeline_peak_memory(tickers, charts):
+    # main() on a cold store in a fresh interpreter: peak RSS covers everything the run holds
+    # at once, interpreter and imports included, without tracemalloc's slowdown on large
+    # universes; chart worker processes are not included
+    import subprocess
+    try:
+        import resource  # noqa: F401  (POSIX only)
+    except ImportError:
+        return {}
+    work_dir = tempfile.mkdtemp(prefix="bench-mem-")
+    config = bench_config(tickers, work_dir, charts=charts)
+    path = os.path.join(work_dir, "config.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(config, f, default=str)
+    run_dir = os.path.join(work_dir, "run")
+    main.ensure_dir(run_dir)
+    here = os.path.dirname(os.path.abspath(__file__))
+    out = subprocess.run([sys.executable, "-c", PIPELINE_CHILD, path, run_dir],
+                         cwd=here, capture_output=True, text=True, check=True,
+                         env=dict(os.environ, PYTHONPATH=here))
+    line = [l for l in out.stdout.splitlines() if l.startswith("BENCH_PEAK_RSS ")][-1]
+    return {"peak_rss_mb": round(float(line.split()[1]), 2)}
+
+IMPORT_BUDGET_SEC = 0.25
+HEAVY_MODULES = ("numpy", "pandas", "matplotlib", "requests", "gspread", "oauth2client", "google.generativeai", "yfinance")
+
+def import_cost(repeat=5):
+    # cold `import main` in a fresh interpreter; heavy backends must stay unloaded until used
+    import subprocess
+    code = (
+        "import sys, time; t = time.perf_counter(); import main; dt = time.perf_counter() - t; "
+        f"print(dt); print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    here = os.path.dirname(os.path.abspath(__file__))
+    times, loaded = [], set()
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", code], cwd=here, capture_output=True, text=True, check=True)
+        lines = out.stdout.strip().splitlines()
+        times.append(float(lines[0]))
+        loaded.update(m for m in (lines[1].split(",") if len(lines) > 1 else []) if m)
+    return {"seconds": round(min(times), 4), "heavy_modules_loaded": sorted(loaded)}
+
+def compare(current, previous, tolerance):
+    regressions = []
+    prev = {u["tickers"]: u["stages"] for u in previous.get("universes", [])}
+    print(f"\n{'universe':>8}  {'stage':<22} {'prev s':>9} {'now s':>9} {'ratio':>7}")
+    for u in current["universes"]:
+        for stage, res in u["stages"].items():
+            old = prev.get(u["tickers"], {}).get(stage)
+            if not old or not old.get("seconds"):
+                continue
+            ratio = res["seconds"] / old["seconds"]
+            flag = ""
+            if ratio > 1 + tolerance and res["seconds"] - old["seconds"] > 0.05:
+                flag = "  <-- regression"
+                regressions.append((u["tickers"], stage, ratio))
+            print(f"{u['tickers']:>8}  {stage:<22} {old['seconds']:>9.3f} {res['seconds']:>9.3f} {ratio:>6.2f}x{flag}")
+    return regressions
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Offline benchmark for main.py")
+    parser.add_argument("--sizes", default="10,500,5000")
+    parser.add_argument("--chart-sample", type=int, default=20)
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass and the pipeline's peak-RSS run")
+    parser.add_argument("--out", default=None)
+    parser.add_argument("--compare", default=None, help="previous results JSON")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown before flagging")
+    parser.add_argument("--import-budget", type=float, default=IMPORT_BUDGET_SEC, help="max seconds for a cold `import main`")
+    args = parser.parse_args()
+
+    results = {
+        "generated": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "universes": [],
+    }
+    results["import_main"] = imp = import_cost()
+    print(f"[bench] import main: {imp['seconds']:.3f}s (budget {args.import_budget:.3f}s)"
+          + (f", eagerly loaded: {', '.join(imp['heavy_modules_loaded'])}" if imp["heavy_modules_loaded"] else ""))
+    over_budget = imp["seconds"] > args.import_budget or bool(imp["heavy_modules_loaded"])
+    for n in [int(x) for x in args.sizes.split(",") if x.strip()]:
+        print(f"[bench] universe of {n} tickers")
+        u = bench_universe(n, chart_sample=args.chart_sample, memory=not args.no_memory)
+        results["universes"].append(u)
+        for stage, res in u["stages"].items():
+            mem = f" peak {res['peak_mb']:.1f} MB" if "peak_mb" in res else ""
+            if "peak_rss_mb" in res:
+                mem += f" peak RSS {res['peak_rss_mb']:.1f} MB"
+            print(f"[bench]   {stage:<22} {res['seconds']:>9.3f}s{mem}")
+
+    out = args.out or os.path.join("reports", f"bench_{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    main.ensure_dir(os.path.dirname(out) or ".")
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=1)
+    print("[bench] results written to", out)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+    if over_budget:
+        print("[bench] import-time budget exceeded")
+    if regressions or over_budget:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main_cli()
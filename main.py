@@ -3,33 +3,82 @@ import re
 import json
 import math
 import time
+import pickle
+import random
+import shutil
+import hashlib
 import yaml
+import cProfile
+import importlib
+import pstats
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 from urllib.parse import quote_plus
 
-import numpy as np
-import pandas as pd
-import requests
 
-try:
-    import matplotlib
-    matplotlib.use("Agg")
-    import matplotlib.pyplot as plt
-except Exception:
-    plt = None
+class LazyModule:
+    # placeholder that imports the module on first attribute access and rebinds the global name
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
 
-try:
-    import gspread
-    from oauth2client.service_account import ServiceAccountCredentials
-except Exception:
-    gspread = None
-    ServiceAccountCredentials = None
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
 
-try:
-    import google.generativeai as genai
-except Exception:
-    genai = None
+np = LazyModule("numpy", "np")
+pd = LazyModule("pandas", "pd")
+requests = LazyModule("requests", "requests")
+
+# Optional backends are imported the first time their stage runs, so skip days and runs
+# with charts/Sheets disabled never pay for matplotlib, gspread or google-generativeai.
+_BACKENDS = {}
+
+def chart_backend():
+    if "charts" not in _BACKENDS:
+        try:
+            import matplotlib
+            matplotlib.use("Agg")
+            from matplotlib.figure import Figure
+            _BACKENDS["charts"] = Figure
+        except Exception as e:
+            print("[Charts] matplotlib not available:", e)
+            _BACKENDS["charts"] = None
+    return _BACKENDS["charts"]
+
+def sheets_backend():
+    if "sheets" not in _BACKENDS:
+        try:
+            import gspread
+            from oauth2client.service_account import ServiceAccountCredentials
+            _BACKENDS["sheets"] = (gspread, ServiceAccountCredentials)
+        except Exception:
+            _BACKENDS["sheets"] = (None, None)
+    return _BACKENDS["sheets"]
+
+def arrow_backend():
+    if "arrow" not in _BACKENDS:
+        try:
+            import pyarrow
+            _BACKENDS["arrow"] = pyarrow
+        except Exception as e:
+            print("[Features] pyarrow not available, feature file export disabled:", e)
+            _BACKENDS["arrow"] = None
+    return _BACKENDS["arrow"]
+
+def llm_backend():
+    if "llm" not in _BACKENDS:
+        try:
+            import google.generativeai as genai
+            _BACKENDS["llm"] = genai
+        except Exception:
+            _BACKENDS["llm"] = None
+    return _BACKENDS["llm"]
 
 
 def load_config(path="config.yml"):
@@ -38,14 +87,32 @@ def load_config(path="config.yml"):
         "skip_if_weekend": True,
         "lookback_days": 260,
         "gemini_model": "gemini-2.5-flash",
-        "news": {"enable": True, "lookback_days": 2, "per_ticker": 3},
+        "gemini": {"shard_size": 10, "max_workers": 4, "max_retries": 2},
+        "llm_cache": {"enable": True, "dir": "data/llm_cache", "ttl_days": 3, "max_entries": 5000, "refresh": False},
+        "news": {"enable": True, "lookback_days": 2, "per_ticker": 3,
+                 "max_workers": 8, "rate_per_sec": 5, "burst": 5, "timeout_sec": 10,
+                 "cache": {"enable": True, "dir": "data/news_cache", "ttl_min": 360, "max_entries": 2000, "max_mb": 20}},
         "risk_management": {"default_stop_loss_pct": 0.03, "default_take_profit_pct": 0.06},
-        "charts": {"enable": True},
+        "charts": {"enable": True, "max_workers": 4},
+        "feature_table": {"export": False, "format": "arrow"},
+        "fetch": {k: dict(v) for k, v in UPSTREAM_DEFAULTS.items()},
+        "sheets": {"mode": "upsert", "chunk_rows": 1000, "bulk_chunk_rows": 5000, "max_retries": 5, "backoff_sec": 1.0},
+        "timeframes": {"enable": True, "list": ["wk", "mo"]},
+        "cross_asset": {"enable": True, "window": 60, "min_obs": 40},
+        "screen": {"enable": True, "top_k": 25, "always": [], "cross_bars": 3, "volume_window": 20,
+                   "weights": {"rsi_extreme": 1.0, "macd_cross": 1.0, "near_high": 0.5, "volume_spike": 1.0}},
+        "backtest": {"history_days": 1500, "hold_days": 20, "onset_only": True, "grid_steps": 40,
+                     "sl_min": 0.01, "sl_max": 0.10, "tp_min": 0.02, "tp_max": 0.20},
         "tickers": ["TSLA","NVDA","AAPL","MSFT","AMZN","ALAB","PLTR","TSM","AMD","RKLB"],
         "indices": ["SPY","QQQ"],
         "commodities": ["USO","BNO"],
         "fx": ["UUP","FXE"],
         "per_call_delay_sec": 0.2,
+        "candles": {"chunk_size": 50, "store": True, "store_dir": "data/candles", "overlap_bars": 5},
+        "indicators": {"incremental": False, "state_dir": "data/indicators"},
+        "offline": False,
+        "profile": False,
+        "pipeline": {"max_workers": 4, "stage_dir": "data/stages", "resume": False},
         "google_news_locale": {"hl": "en-US", "gl": "US", "ceid": "US:en"}
     }
     if os.path.exists(path):
@@ -60,6 +127,84 @@ def load_config(path="config.yml"):
 def ensure_dir(path):
     os.makedirs(path, exist_ok=True)
 
+
+# Tracing: spans around pipeline stages and network calls, written as JSON next to the report.
+class Tracer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.t0 = time.perf_counter()
+        self.started = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        self.spans = []
+        self.counters = {}
+
+    @contextmanager
+    def span(self, name, **attrs):
+        stack = self.local.__dict__.setdefault("stack", [])
+        rec = {"name": name, "parent": stack[-1]["name"] if stack else None,
+               "thread": threading.current_thread().name, "attrs": attrs}
+        start = time.perf_counter()
+        rec["start"] = round(start - self.t0, 6)
+        stack.append(rec)
+        try:
+            yield rec["attrs"]
+        except Exception as e:
+            rec["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            stack.pop()
+            rec["seconds"] = round(time.perf_counter() - start, 6)
+            with self.lock:
+                self.spans.append(rec)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add(self, key, n=1):
+        # bump a numeric attribute (retries, ...) of this thread's innermost open span
+        stack = self.local.__dict__.get("stack")
+        if stack:
+            attrs = stack[-1]["attrs"]
+            attrs[key] = int(attrs.get(key) or 0) + n
+
+    def fail(self, e):
+        # mark the innermost open span as failed when the caller handles the exception itself
+        stack = self.local.__dict__.get("stack")
+        if stack:
+            stack[-1]["error"] = f"{type(e).__name__}: {e}"
+
+    def summary(self):
+        groups = {}
+        for sp in self.spans:
+            g = groups.setdefault(sp["name"], {"calls": 0, "seconds": 0.0, "max": 0.0, "errors": 0,
+                                               "bytes": 0, "symbols": 0, "retries": 0})
+            g["calls"] += 1
+            g["seconds"] += sp["seconds"]
+            g["max"] = max(g["max"], sp["seconds"])
+            g["errors"] += "error" in sp
+            for k in ("bytes", "symbols", "retries"):
+                g[k] += int(sp["attrs"].get(k, 0) or 0)
+        return groups
+
+    def table(self):
+        rows = [f"{'span':<24}{'calls':>7}{'total s':>10}{'max s':>9}{'symbols':>9}{'bytes':>12}{'retries':>8}{'errors':>7}"]
+        for name, g in sorted(self.summary().items(), key=lambda kv: (not kv[0].startswith("stage:"), -kv[1]["seconds"])):
+            rows.append(f"{name:<24}{g['calls']:>7}{g['seconds']:>10.3f}{g['max']:>9.3f}{g['symbols']:>9}"
+                        f"{g['bytes']:>12}{g['retries']:>8}{g['errors']:>7}")
+        return "\n".join(rows)
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"started": self.started, "wall_seconds": round(time.perf_counter() - self.t0, 6),
+                       "counters": self.counters, "summary": self.summary(), "spans": self.spans},
+                      f, indent=1, default=str)
+
+TRACER = Tracer()
+
 def fmt_pct(x, digits=2):
     if pd.isna(x):
         return "-"
@@ -115,40 +260,531 @@ def pct_change(series, periods=1):
     return series.pct_change(periods=periods)
 
 
-def yahoo_candles(symbol: str, lookback_days=400):
+# Fetch layer shared by Yahoo, Google News and Gemini: a hard per-call timeout, jittered
+# exponential retries on transient errors, an optional hedged duplicate when the first try
+# is slow, and a circuit breaker per upstream so a dead service fails fast for the rest of
+# the run. Callers fall back to their own caches when a call gives up.
+class CircuitOpen(RuntimeError):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, name, failures=5, reset_sec=60.0):
+        self.name = name
+        self.threshold = max(1, int(failures))
+        self.reset_sec = float(reset_sec)
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_sec:
+                # half-open: let one call through and re-open at once if it fails
+                self.opened_at = None
+                self.failures = self.threshold - 1
+                return True
+            return False
+
+    def record(self, ok):
+        with self.lock:
+            if ok:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures >= self.threshold and self.opened_at is None:
+                self.opened_at = time.monotonic()
+                TRACER.count(f"{self.name}_breaker_open")
+                print(f"[Fetch] {self.name}: circuit open for {self.reset_sec:g}s after {self.failures} failures")
+
+def http_status(e):
+    resp = getattr(e, "response", None)
+    return getattr(resp, "status_code", None) or getattr(e, "code", None)
+
+def retryable(e):
+    # timeouts and connection errors carry no status; 4xx other than 429 will not get better
+    status = http_status(e)
+    return status is None or status == 429 or (isinstance(status, int) and status >= 500)
+
+def backoff_delay(attempt, backoff_sec):
+    return backoff_sec * (2 ** attempt) * (0.5 + random.random())
+
+def run_with_timeout(fn, args, kwargs, timeout, hedge_after=None):
+    # daemon threads so a call that never returns cannot hold up interpreter exit
+    import queue
+    results = queue.Queue()
+
+    def worker():
+        try:
+            results.put((True, fn(*args, **kwargs)))
+        except BaseException as e:
+            results.put((False, e))
+
+    deadline = time.monotonic() + timeout
+    threading.Thread(target=worker, daemon=True).start()
+    launched, hedged, error = 1, False, None
+    while True:
+        if hedge_after and not hedged:
+            wait = min(hedge_after, deadline - time.monotonic())
+        else:
+            wait = deadline - time.monotonic()
+        try:
+            ok, value = results.get(timeout=max(wait, 0))
+        except queue.Empty:
+            if hedge_after and not hedged and time.monotonic() < deadline:
+                hedged = True
+                launched += 1
+                threading.Thread(target=worker, daemon=True).start()
+                continue
+            raise TimeoutError(f"no response within {timeout:g}s") from error
+        if ok:
+            return value, hedged
+        error = value
+        launched -= 1
+        if launched == 0:
+            raise error
+
+class Upstream:
+    # serial: at most one call in flight. A call that timed out keeps running on its thread, so
+    # for clients with shared global state (yfinance) it holds the lock until it really ends;
+    # later calls wait for it, retries give up instead of overlapping it, and there is no hedging
+    def __init__(self, name, timeout_sec=30.0, retries=2, backoff_sec=1.0, hedge_after_sec=0,
+                 breaker_failures=5, breaker_reset_sec=60.0, serial=False, sleep=time.sleep):
+        self.name = name
+        self.timeout = float(timeout_sec)
+        self.retries = max(0, int(retries))
+        self.backoff = float(backoff_sec)
+        self.in_flight = threading.Lock() if serial else None
+        self.hedge_after = None if serial else float(hedge_after_sec or 0) or None
+        self.breaker = CircuitBreaker(name, breaker_failures, breaker_reset_sec)
+        self.sleep = sleep
+
+    def _attempt(self, fn, args, kwargs):
+        if self.in_flight is None:
+            return run_with_timeout(fn, args, kwargs, self.timeout, self.hedge_after)
+        if not self.in_flight.acquire(timeout=self.timeout):
+            raise TimeoutError(f"{self.name}: an earlier call is still running after {self.timeout:g}s")
+
+        def locked(*a, **kw):
+            try:
+                return fn(*a, **kw)
+            finally:
+                self.in_flight.release()
+        return run_with_timeout(locked, args, kwargs, self.timeout)
+
+    def call(self, fn, *args, **kwargs):
+        if not self.breaker.allow():
+            TRACER.count(f"{self.name}_short_circuited")
+            raise CircuitOpen(f"{self.name} circuit open")
+        for attempt in range(self.retries + 1):
+            try:
+                out, hedged = self._attempt(fn, args, kwargs)
+                if hedged:
+                    TRACER.count(f"{self.name}_hedged")
+                self.breaker.record(True)
+                return out
+            except Exception as e:
+                abandoned = self.in_flight is not None and self.in_flight.locked()
+                if attempt >= self.retries or not retryable(e) or abandoned:
+                    self.breaker.record(False)
+                    raise
+                TRACER.count(f"{self.name}_retries")
+                TRACER.add("retries")
+                delay = backoff_delay(attempt, self.backoff)
+                print(f"[Fetch] {self.name}: {type(e).__name__}: {e}; retry {attempt + 1}/{self.retries} in {delay:.1f}s")
+                self.sleep(delay)
+
+UPSTREAM_DEFAULTS = {
+    "yahoo": {"timeout_sec": 90, "retries": 2, "backoff_sec": 2.0, "hedge_after_sec": 0,
+              "breaker_failures": 3, "breaker_reset_sec": 300, "serial": True},
+    "news": {"timeout_sec": 15, "retries": 2, "backoff_sec": 0.5, "hedge_after_sec": 3,
+             "breaker_failures": 8, "breaker_reset_sec": 60},
+    "gemini": {"timeout_sec": 180, "retries": 1, "backoff_sec": 2.0, "hedge_after_sec": 0,
+               "breaker_failures": 3, "breaker_reset_sec": 300},
+}
+_UPSTREAMS = {}
+
+def configure_upstreams(config):
+    cfg = config.get("fetch", {}) or {}
+    for name, default in UPSTREAM_DEFAULTS.items():
+        _UPSTREAMS[name] = Upstream(name, **dict(default, **(cfg.get(name) or {})))
+
+def upstream(name):
+    if name not in _UPSTREAMS:
+        _UPSTREAMS[name] = Upstream(name, **UPSTREAM_DEFAULTS.get(name, {}))
+    return _UPSTREAMS[name]
+
+
+OHLCV = ["Open", "High", "Low", "Close", "Volume"]
+
+def offline_mode(config):
+    return bool(config.get("offline", False)) or os.getenv("OFFLINE", "").strip() == "1"
+
+def candle_downloader(config):
+    if offline_mode(config):
+        from offline import synthetic_download
+        return synthetic_download
+    return None
+
+def naive_index(index):
+    index = pd.to_datetime(index)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    return index
+
+def split_ohlcv(raw, symbols):
+    frames, failures = {}, {}
+    if raw is None or raw.empty:
+        return frames, {s: "empty batch" for s in symbols}
+    multi = isinstance(raw.columns, pd.MultiIndex)
+    present = set(raw.columns.get_level_values(0)) if multi else set()
+    for s in symbols:
+        try:
+            if multi:
+                if s not in present:
+                    failures[s] = "missing from batch"
+                    continue
+                df = raw[s]
+            else:
+                df = raw
+            df = df[OHLCV].copy()
+            df.index = naive_index(df.index)
+            df = df.dropna(how="any").sort_index()
+            if df.empty:
+                failures[s] = "no data"
+                continue
+            frames[s] = df
+        except Exception as e:
+            failures[s] = str(e)
+    return frames, failures
+
+def candle_window(lookback_days, now=None):
+    end = now or datetime.now(timezone.utc)
+    start = end - timedelta(days=int(lookback_days * 1.4))
+    return start.date(), end.date()
+
+def download_batch(download, chunk, start, end):
+    raw = download(
+        chunk,
+        start=start.isoformat(),
+        end=end.isoformat(),
+        interval="1d",
+        progress=False,
+        auto_adjust=False,
+        threads=True,
+        group_by="ticker",
+    )
+    # yfinance reports a failed request as an empty frame, which should be retried like an error
+    if raw is None or raw.empty:
+        raise ConnectionError("empty response")
+    return raw
+
+def yahoo_candles_bulk(symbols, lookback_days=400, chunk_size=50, delay_sec=0.0, download=None, start=None):
+    symbols = list(dict.fromkeys(s for s in symbols if s))
+    if not symbols:
+        return {}, {}
+    if download is None:
+        try:
+            import yfinance as yf
+        except Exception as e:
+            print("[Yahoo] yfinance not installed:", e)
+            return {}, {s: "yfinance not installed" for s in symbols}
+        download = yf.download
+
+    window_start, end = candle_window(lookback_days)
+    start = start or window_start
+    chunk_size = max(1, int(chunk_size))
+    frames, failures = {}, {}
+    for i in range(0, len(symbols), chunk_size):
+        chunk = symbols[i:i + chunk_size]
+        with TRACER.span("yahoo_candles", symbols=len(chunk), start=start.isoformat()) as sp:
+            try:
+                raw = upstream("yahoo").call(download_batch, download, chunk, start, end)
+            except Exception as e:
+                print(f"[Yahoo] batch error {chunk[0]}..{chunk[-1]}: {e}")
+                TRACER.fail(e)
+                failures.update({s: str(e) for s in chunk})
+                sp["failed"] = len(chunk)
+                raw = None
+            if raw is not None:
+                # decoded size; yfinance does not expose the wire bytes
+                sp["bytes"] = int(raw.memory_usage(deep=False).sum())
+                got, bad = split_ohlcv(raw, chunk)
+                frames.update(got)
+                failures.update(bad)
+                sp["failed"] = len(bad)
+        if delay_sec > 0 and i + chunk_size < len(symbols):
+            time.sleep(delay_sec)
+    for s, why in failures.items():
+        print(f"[Yahoo] no data for {s}: {why}")
+    return frames, failures
+
+def yahoo_candles(symbol: str, lookback_days=400, download=None):
+    frames, _ = yahoo_candles_bulk([symbol], lookback_days, download=download)
+    return frames.get(symbol, pd.DataFrame())
+
+
+# On-disk candle store: one columnar float64 array per symbol, shape (6, n_bars),
+# rows = [epoch day, Open, High, Low, Close, Volume], readable with mmap.
+def store_path(store_dir, symbol):
+    return os.path.join(store_dir, re.sub(r"[^A-Za-z0-9._-]", "_", symbol) + ".npy")
+
+def load_stored_candles(store_dir, symbol):
+    path = store_path(store_dir, symbol)
+    if not os.path.exists(path):
+        return pd.DataFrame()
     try:
-        import yfinance as yf
+        arr = np.load(path, mmap_mode="r")
+        index = pd.to_datetime(np.asarray(arr[0]).astype("int64"), unit="D")
+        return pd.DataFrame(np.asarray(arr[1:]).T, index=index, columns=OHLCV)
     except Exception as e:
-        print("[Yahoo] yfinance not installed:", e)
+        print(f"[Store] unreadable {path}: {e}")
         return pd.DataFrame()
 
+def save_stored_candles(store_dir, symbol, df):
+    ensure_dir(store_dir)
+    days = df.index.values.astype("datetime64[D]").astype("int64").astype("float64")
+    arr = np.vstack([days, df[OHLCV].to_numpy(dtype="float64").T])
+    path = store_path(store_dir, symbol)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, arr)
+    os.replace(tmp, path)
+
+def load_store_index(store_dir):
+    path = os.path.join(store_dir, "_index.json")
+    if not os.path.exists(path):
+        return {}
     try:
-        end = datetime.now(timezone.utc)
-        start = end - timedelta(days=int(lookback_days * 1.4))
-        df = yf.download(
-            symbol,
-            start=start.date().isoformat(),
-            end=end.date().isoformat(),
-            interval="1d",
-            progress=False,
-            auto_adjust=False,
-            threads=True,
-        )
-        if df is None or df.empty:
-            print(f"[Yahoo] no data for {symbol}")
-            return pd.DataFrame()
-        df = df.rename(columns={
-            "Open": "Open", "High": "High", "Low": "Low", "Close": "Close", "Volume": "Volume"
-        })
-        df.index = pd.to_datetime(df.index)
-        df = df[["Open","High","Low","Close","Volume"]].dropna(how="any")
-        return df.sort_index()
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def save_store_index(store_dir, index):
+    ensure_dir(store_dir)
+    with open(os.path.join(store_dir, "_index.json"), "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+
+def restated(old, new, tol=1e-6):
+    common = old.index.intersection(new.index)
+    if len(common) == 0:
+        return True
+    a = old.loc[common, ["Open", "High", "Low", "Close"]].to_numpy(dtype="float64")
+    b = new.loc[common, ["Open", "High", "Low", "Close"]].to_numpy(dtype="float64")
+    return bool(np.any(np.abs(b / a - 1.0) > tol))
+
+def stale_frame(df):
+    # candles served from the store because the refresh failed; shown as stale in the report
+    df = df.copy()
+    df.attrs["stale"] = True
+    return df
+
+def load_candles(symbols, lookback_days, config, download=None):
+    cfg = config.get("candles", {})
+    chunk_size = int(cfg.get("chunk_size", 50))
+    delay = float(config.get("per_call_delay_sec", 0.0))
+    store_dir = cfg.get("store_dir", "data/candles")
+    if not cfg.get("store", True) or not store_dir:
+        return yahoo_candles_bulk(symbols, lookback_days, chunk_size=chunk_size, delay_sec=delay, download=download)
+
+    symbols = list(dict.fromkeys(s for s in symbols if s))
+    overlap = max(1, int(cfg.get("overlap_bars", 5)))
+    tol = float(cfg.get("restate_tol", 1e-6))
+    window_start, _ = candle_window(lookback_days)
+    index = load_store_index(store_dir)
+
+    stored, full, gaps = {}, [], {}
+    for s in symbols:
+        old = load_stored_candles(store_dir, s)
+        covered = index.get(s, {}).get("start")
+        if old.empty or not covered or covered > window_start.isoformat():
+            full.append(s)
+            continue
+        stored[s] = old
+        gap_start = old.index[-min(overlap, len(old))].date()
+        gaps.setdefault(gap_start, []).append(s)
+
+    frames, failures = {}, {}
+    for gap_start, group in sorted(gaps.items()):
+        got, bad = yahoo_candles_bulk(group, lookback_days, chunk_size=chunk_size, delay_sec=delay,
+                                      download=download, start=gap_start)
+        for s in group:
+            old, new = stored[s], got.get(s)
+            if new is None or new.empty:
+                # keep serving from the store when Yahoo fails or is slow
+                print(f"[Store] using cached candles for {s} (last bar {old.index[-1].date()})")
+                frames[s] = stale_frame(old)
+            elif restated(old, new, tol):
+                print(f"[Store] {s} restated (split/adjustment?) — full refresh")
+                full.append(s)
+            else:
+                frames[s] = pd.concat([old[old.index < new.index[0]], new])
+
+    if full:
+        got, bad = yahoo_candles_bulk(full, lookback_days, chunk_size=chunk_size, delay_sec=delay,
+                                      download=download, start=window_start)
+        for s in full:
+            if s in got:
+                frames[s] = got[s]
+                index[s] = {"start": window_start.isoformat()}
+            elif s in stored:
+                frames[s] = stale_frame(stored[s])
+            else:
+                failures[s] = bad.get(s, "no data")
+
+    cutoff = pd.Timestamp(window_start)
+    for s, df in frames.items():
+        df = df[df.index >= cutoff]
+        frames[s] = df
+        try:
+            save_stored_candles(store_dir, s, df)
+            index.setdefault(s, {"start": window_start.isoformat()})
+            index[s]["last"] = df.index[-1].strftime("%Y-%m-%d") if len(df) else ""
+        except Exception as e:
+            print(f"[Store] cannot write {s}: {e}")
+    try:
+        save_store_index(store_dir, index)
     except Exception as e:
-        print(f"[Yahoo] error {symbol}: {e}")
-        return pd.DataFrame()
+        print(f"[Store] cannot write index: {e}")
+    print(f"[Store] {len(frames)} symbols ({len(full)} full refresh, {len(symbols) - len(full)} incremental)")
+    return frames, failures
+
+
+
+class TokenBucket:
+    def __init__(self, rate_per_sec, burst=1):
+        self.rate = float(rate_per_sec)
+        self.capacity = max(1.0, float(burst))
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
 
+_HTTP_SESSION = None
+
+def http_session(pool_size=16):
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None:
+        from requests.adapters import HTTPAdapter
+        sess = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        sess.mount("https://", adapter)
+        sess.mount("http://", adapter)
+        sess.headers["User-Agent"] = "Mozilla/5.0 (ai-daily-stock)"
+        _HTTP_SESSION = sess
+    return _HTTP_SESSION
+
+def news_session(config):
+    if offline_mode(config):
+        from offline import FakeNewsSession
+        return FakeNewsSession()
+    return http_session()
+
+def google_news_url(query_text, lookback_days=2, locale=None):
+    locale = locale or {"hl": "en-US", "gl": "US", "ceid": "US:en"}
+    q = quote_plus(f'{query_text} when:{lookback_days}d')
+    return f"https://news.google.com/rss/search?q={q}&hl={locale['hl']}&gl={locale['gl']}&ceid={locale['ceid']}"
+
+def parse_news_entries(feed, limit):
+    items = []
+    for e in feed.entries[:limit]:
+        title = getattr(e, "title", "").strip()
+        link  = getattr(e, "link", "").strip()
+        pub   = getattr(e, "published", "")
+        src   = getattr(getattr(e, "source", {}), "title", "") or "Google News"
+        items.append({"title": title, "link": link, "published": pub, "source": src})
+    return items
+
+class NewsCache:
+    # disk-backed feed cache keyed by (query, locale, lookback); one JSON file per key
+    def __init__(self, cache_dir, ttl_sec=6 * 3600, max_entries=2000, max_bytes=20 * 1024 * 1024):
+        self.dir = cache_dir
+        self.ttl = float(ttl_sec)
+        self.max_entries = int(max_entries)
+        self.max_bytes = int(max_bytes)
+        ensure_dir(cache_dir)
+
+    @staticmethod
+    def key(query_text, locale, lookback_days):
+        raw = json.dumps([query_text, locale or {}, int(lookback_days)], sort_keys=True)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.dir, key + ".json")
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            return None
 
-def google_news_company(query_text: str, lookback_days=2, limit=3, locale=None):
+    def fresh(self, entry):
+        return entry is not None and time.time() - entry.get("fetched_at", 0) < self.ttl
+
+    def put(self, key, items, etag=None, last_modified=None):
+        entry = {"fetched_at": time.time(), "etag": etag, "last_modified": last_modified, "items": items}
+        path = self._path(key)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        return entry
+
+    def touch(self, key, entry):
+        return self.put(key, entry["items"], entry.get("etag"), entry.get("last_modified"))
+
+    def evict(self):
+        files = []
+        for name in os.listdir(self.dir):
+            if name.endswith(".json"):
+                p = os.path.join(self.dir, name)
+                st = os.stat(p)
+                files.append((st.st_mtime, st.st_size, p))
+        files.sort(reverse=True)
+        total, kept = 0, 0
+        for mtime, size, p in files:
+            total += size
+            kept += 1
+            # entries far past their TTL cannot even be revalidated usefully
+            if kept > self.max_entries or total > self.max_bytes or time.time() - mtime > 7 * 86400:
+                os.remove(p)
+
+def news_cache(cfg_news):
+    cfg = cfg_news.get("cache", {})
+    if not cfg.get("enable", True):
+        return None
+    try:
+        return NewsCache(cfg.get("dir", "data/news_cache"),
+                         ttl_sec=float(cfg.get("ttl_min", 360)) * 60,
+                         max_entries=int(cfg.get("max_entries", 2000)),
+                         max_bytes=float(cfg.get("max_mb", 20)) * 1024 * 1024)
+    except Exception as e:
+        print("[News] cache disabled:", e)
+        return None
+
+def news_get(session, url, timeout, headers):
+    resp = session.get(url, timeout=timeout, headers=headers)
+    if resp.status_code == 429 or resp.status_code >= 500:
+        resp.raise_for_status()
+    return resp
+
+def google_news_company(query_text: str, lookback_days=2, limit=3, locale=None, session=None, timeout=10.0, cache=None):
     try:
         import feedparser
     except Exception as e:
@@ -158,23 +794,86 @@ def google_news_company(query_text: str, lookback_days=2, limit=3, locale=None):
     if not query_text:
         return []
 
-    locale = locale or {"hl": "en-US", "gl": "US", "ceid": "US:en"}
-    q = quote_plus(f'{query_text} when:{lookback_days}d')
-    url = f"https://news.google.com/rss/search?q={q}&hl={locale['hl']}&gl={locale['gl']}&ceid={locale['ceid']}"
+    url = google_news_url(query_text, lookback_days, locale)
+    key = NewsCache.key(query_text, locale, lookback_days) if cache else None
+    entry = cache.get(key) if cache else None
+    if cache and cache.fresh(entry):
+        TRACER.count("news_cache_hits")
+        return entry["items"][:limit]
+    headers = {}
+    if entry and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry and entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    with TRACER.span("google_news_company", query=query_text, symbols=1) as sp:
+        try:
+            resp = upstream("news").call(news_get, session or http_session(), url, timeout, headers)
+            sp["status"] = resp.status_code
+            sp["bytes"] = len(resp.content or b"")
+            if resp.status_code == 304 and entry:
+                cache.touch(key, entry)
+                return entry["items"][:limit]
+            resp.raise_for_status()
+            items = parse_news_entries(feedparser.parse(resp.content), None)
+            if cache:
+                cache.put(key, items, resp.headers.get("ETag"), resp.headers.get("Last-Modified"))
+            return items[:limit]
+        except Exception as e:
+            print(f"[News] error for query={query_text}: {e}")
+            TRACER.fail(e)
+            sp["failed"] = str(e)
+            if entry:
+                TRACER.count("news_stale")
+                return [dict(it, stale=True) for it in entry["items"][:limit]]
+            return []
 
-    try:
-        feed = feedparser.parse(url)
-        items = []
-        for e in feed.entries[:limit]:
-            title = getattr(e, "title", "").strip()
-            link  = getattr(e, "link", "").strip()
-            pub   = getattr(e, "published", "")
-            src   = getattr(getattr(e, "source", {}), "title", "") or "Google News"
-            items.append({"title": title, "link": link, "published": pub, "source": src})
-        return items
-    except Exception as e:
-        print(f"[News] error for query={query_text}: {e}")
-        return []
+def news_fingerprints(item):
+    link = (item.get("link") or "").strip().lower()
+    link = re.sub(r"^https?://(www\.)?", "", link).split("?")[0].split("#")[0].rstrip("/")
+    title = (item.get("title") or "").lower()
+    title = re.sub(r"\s+-\s+[^-]+$", "", title)  # trailing " - Source"
+    title = " ".join(re.findall(r"[a-z0-9\u0e00-\u0e7f]+", title))
+    return [hashlib.sha1(x.encode("utf-8")).hexdigest() for x in (link, title) if x]
+
+def dedupe_news(news_map, limit=None):
+    seen = set()
+    out = {}
+    for t, items in news_map.items():
+        kept = []
+        for it in items or []:
+            fps = news_fingerprints(it)
+            if any(fp in seen for fp in fps):
+                continue
+            seen.update(fps)
+            kept.append(it)
+        out[t] = kept[:limit] if limit else kept
+    return out
+
+def fetch_news_map(queries, cfg_news, locale=None, session=None):
+    per_ticker = int(cfg_news.get("per_ticker", 3))
+    lb_days = int(cfg_news.get("lookback_days", 2))
+    timeout = float(cfg_news.get("timeout_sec", 10))
+    workers = max(1, int(cfg_news.get("max_workers", 8)))
+    bucket = TokenBucket(float(cfg_news.get("rate_per_sec", 5)), cfg_news.get("burst", 5))
+    session = session or http_session(pool_size=workers)
+    cache = news_cache(cfg_news)
+    # fetch more than per_ticker so headlines dropped as cross-ticker duplicates can be backfilled
+    fetch_limit = per_ticker * 3
+
+    def one(query):
+        bucket.acquire()
+        return google_news_company(query, lookback_days=lb_days, limit=fetch_limit, locale=locale,
+                                   session=session, timeout=timeout, cache=cache)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {t: pool.submit(one, q) for t, q in queries.items()}
+        news_map = {t: fut.result() for t, fut in futures.items()}
+    if cache:
+        try:
+            cache.evict()
+        except Exception as e:
+            print("[News] cache eviction failed:", e)
+    return dedupe_news(news_map, per_ticker)
 
 
 COMPANY_NAME = {
@@ -218,6 +917,9 @@ def build_features(ticker, df):
     lookback_252 = close.tail(252) if len(close) >= 252 else close
     out["high_52w"] = to_scalar(lookback_252.max())
     out["low_52w"] = to_scalar(lookback_252.min())
+    return label_features(out)
+
+def label_features(out):
     out["off_high_52w_pct"] = float((out["price"]/out["high_52w"]) - 1.0) if out["high_52w"] else np.nan
     out["above_low_52w_pct"] = float((out["price"]/out["low_52w"]) - 1.0) if out["low_52w"] else np.nan
 
@@ -230,36 +932,676 @@ def build_features(ticker, df):
     return out
 
 
-def build_ai_prompt(config, market_overview, features_list, news_map):
-    tz = config.get("timezone", "Asia/Bangkok")
-    today = datetime.now(ZoneInfo(tz)).strftime("%Y-%m-%d")
-    risk = config.get("risk_management", {})
-    dsl = risk.get("default_stop_loss_pct", 0.03)
-    dtp = risk.get("default_take_profit_pct", 0.06)
+# Panel engine: the same indicators as build_features for many symbols at once.
+# Symbols are right-aligned on their last bar in one (bars x symbols) matrix, so each
+# column holds exactly that symbol's own history with NaN padding on top; for a shared
+# trading calendar this is the dates x tickers matrix.
+def right_align(columns):
+    n = max((len(v) for v in columns), default=0)
+    mat = np.full((n, len(columns)), np.nan)
+    for j, v in enumerate(columns):
+        if len(v):
+            mat[n - len(v):, j] = v
+    return mat
 
-    overview_joined = "; ".join(
-        f"{k}:{item['ticker']} p={fmt_price(item['price'])} 1d={fmt_pct(item['chg_1d'])} rsi={item['rsi14']:.1f} trend={item['trend_sma']}"
-        for k, arr in market_overview.items() if arr
-        for item in arr
-    ) or "-"
+def align_panel(frames, symbols, column="Close"):
+    return right_align([frames[s][column].to_numpy(dtype="float64") for s in symbols])
+
+def ewm_panel(x, com, min_periods=0):
+    # column-wise replica of pandas .ewm(com=..., adjust=False).mean()
+    alpha = 1.0 / (1.0 + com)
+    old_wt, new_wt = 1.0 - alpha, alpha
+    out = np.full(x.shape, np.nan)
+    w = np.full(x.shape[1:], np.nan)
+    nobs = np.zeros(x.shape[1:], dtype=np.int64)
+    minp = max(int(min_periods), 1)
+    for t in range(x.shape[0]):
+        cur = x[t]
+        obs = ~np.isnan(cur)
+        nobs += obs
+        started = ~np.isnan(w)
+        upd = obs & started & (w != cur)
+        w = np.where(obs & ~started, cur, w)
+        w = np.where(upd, (old_wt * w + new_wt * cur) / (old_wt + new_wt), w)
+        out[t] = np.where(nobs >= minp, w, np.nan)
+    return out
 
-    feat_lines = []
-    for f in features_list:
-        feat_lines.append(
-            f"{f['ticker']} price={fmt_price(f['price'])} 1d={fmt_pct(f['chg_1d'])} 5d={fmt_pct(f['chg_5d'])} 20d={fmt_pct(f['chg_20d'])} "
-            f"SMA20/50/200={fmt_price(f['sma20'])}/{fmt_price(f['sma50'])}/{fmt_price(f['sma200'])} "
-            f"RSI14={f['rsi14']:.1f}({f['rsi_state']}) MACD={f['macd']:.3f}/{f['macd_signal']:.3f}({f['macd_state']}) "
-            f"52wH/L={fmt_price(f['high_52w'])}/{fmt_price(f['low_52w'])} offHigh={fmt_pct(f['off_high_52w_pct'])}"
+def rsi_panel(close, period=14):
+    delta = np.full(close.shape, np.nan)
+    delta[1:] = close[1:] - close[:-1]
+    up = np.clip(delta, 0, None)
+    down = -np.clip(delta, None, 0)
+    roll_up = ewm_panel(up, 1.0 / (1.0 / period) - 1.0, min_periods=period)
+    roll_down = ewm_panel(down, 1.0 / (1.0 / period) - 1.0, min_periods=period)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rs = roll_up / roll_down
+        return 100 - (100 / (1 + rs))
+
+def macd_panel(close, fast=12, slow=26, signal=9):
+    macd_line = ewm_panel(close, (fast - 1) / 2.0) - ewm_panel(close, (slow - 1) / 2.0)
+    signal_line = ewm_panel(macd_line, (signal - 1) / 2.0)
+    return macd_line, signal_line, macd_line - signal_line
+
+def last_sma(close, window):
+    if close.shape[0] < window:
+        return np.full(close.shape[1:], np.nan)
+    return close[-window:].mean(axis=0)
+
+def last_pct_change(close, periods):
+    if close.shape[0] <= periods:
+        return np.full(close.shape[1:], np.nan)
+    return close[-1] / close[-1 - periods] - 1
+
+def panel_columns(close):
+    # latest-bar indicator values for every column of a right-aligned close matrix
+    with np.errstate(invalid="ignore", divide="ignore"):
+        macd_line, signal_line, hist = macd_panel(close, 12, 26, 9)
+        tail = close[-252:]
+        return {
+            "price": close[-1],
+            "sma20": last_sma(close, 20),
+            "sma50": last_sma(close, 50),
+            "sma200": last_sma(close, 200),
+            "rsi14": rsi_panel(close, 14)[-1],
+            "macd": macd_line[-1],
+            "macd_signal": signal_line[-1],
+            "macd_hist": hist[-1],
+            "chg_1d": last_pct_change(close, 1),
+            "chg_5d": last_pct_change(close, 5),
+            "chg_20d": last_pct_change(close, 20),
+            "high_52w": np.nanmax(tail, axis=0) if tail.size else np.full(close.shape[1:], np.nan),
+            "low_52w": np.nanmin(tail, axis=0) if tail.size else np.full(close.shape[1:], np.nan),
+        }
+
+# Columnar feature table: one typed array per feature and small integer codes for the labels.
+# Rows are handed out as the same dicts build_features returns, so code written against
+# per-ticker dicts keeps working, while large universes avoid holding thousands of dicts.
+class FeatureTable:
+    INDICATORS = ("price", "sma20", "sma50", "sma200", "rsi14", "macd", "macd_signal", "macd_hist",
+                  "chg_1d", "chg_5d", "chg_20d", "high_52w", "low_52w")
+    NUMERIC = INDICATORS + ("off_high_52w_pct", "above_low_52w_pct")
+    LABELS = {
+        "trend_sma": ("Down/Sideways", "Uptrend"),
+        "rsi_state": ("Neutral", "Overbought", "Oversold"),
+        "macd_state": ("Bearish", "Bullish"),
+    }
+
+    def __init__(self, tickers, last_dates, cols, codes=None):
+        self.tickers = np.asarray(tickers, dtype=object)
+        self.last_dates = np.asarray(last_dates, dtype="datetime64[D]")
+        # daily columns first, then the "<tf>_" columns of each resampled timeframe and the
+        # "x_<factor>_" cross-asset columns
+        keys = [k for k in self.NUMERIC if k in cols]
+        keys += [f"{tf}_{k}" for tf in TIMEFRAMES for k in TF_FIELDS.values() if f"{tf}_{k}" in cols]
+        keys += [k for k in cols if k.startswith("x_")]
+        self.cols = {k: np.asarray(cols[k], dtype="float64") for k in keys}
+        if codes is None:
+            self._derive()
+        else:
+            self.codes = {k: np.asarray(v, dtype=np.int8) for k, v in codes.items()}
+        self._index = None
+        self._lists = None
+
+    @staticmethod
+    def _label_codes(price, fast, slow, rsi14, macd, signal):
+        slow = np.where(np.isnan(slow), -1e9, slow)
+        return (
+            ((price > fast) & (fast > slow)).astype(np.int8),
+            np.where(rsi14 >= 70, 1, np.where(rsi14 <= 30, 2, 0)).astype(np.int8),
+            (macd > signal).astype(np.int8),
         )
-    feat_block = "- " + "\n- ".join(feat_lines) if feat_lines else "-"
 
-    news_lines = []
-    for t, items in news_map.items():
-        if not items:
+    def _derive(self):
+        # vectorized label_features(); resampled timeframes trend on their own SMA20/SMA50
+        c = self.cols
+        price, high, low = c["price"], c["high_52w"], c["low_52w"]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            c["off_high_52w_pct"] = np.where(high != 0, price / high - 1.0, np.nan)
+            c["above_low_52w_pct"] = np.where(low != 0, price / low - 1.0, np.nan)
+        labels = {"": self._label_codes(price, c["sma50"], c["sma200"], c["rsi14"], c["macd"], c["macd_signal"])}
+        for tf in TIMEFRAMES:
+            if f"{tf}_rsi14" in c:
+                labels[f"{tf}_"] = self._label_codes(price, c[f"{tf}_sma20"], c[f"{tf}_sma50"], c[f"{tf}_rsi14"],
+                                                     c[f"{tf}_macd"], c[f"{tf}_macd_signal"])
+        self.codes = {prefix + k: v for prefix, codes in labels.items() for k, v in zip(self.LABELS, codes)}
+
+    def categories(self, key):
+        return self.LABELS[key if key in self.LABELS else key.split("_", 1)[1]]
+
+    @classmethod
+    def from_dicts(cls, rows):
+        rows = [r for r in rows if r]
+        return cls([r["ticker"] for r in rows], [r["last_date"] for r in rows],
+                   {k: [r[k] for r in rows] for k in cls.INDICATORS})
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def __contains__(self, ticker):
+        return ticker in self.index
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.take(np.arange(len(self))[key])
+        return self.row(self.index[key])
+
+    def __iter__(self):
+        return (self.row(i) for i in range(len(self)))
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = {t: i for i, t in enumerate(self.tickers.tolist())}
+        return self._index
+
+    def get(self, ticker, default=None):
+        i = self.index.get(ticker)
+        return default if i is None else self.row(i)
+
+    def row(self, i):
+        if self._lists is None:
+            self._lists = {k: v.tolist() for k, v in self.cols.items()}
+            self._lists["last_date"] = np.datetime_as_string(self.last_dates, unit="D").tolist()
+        out = {"ticker": self.tickers[i], "last_date": self._lists["last_date"][i]}
+        for k in self.cols:
+            out[k] = self._lists[k][i]
+        for k, codes in self.codes.items():
+            out[k] = self.categories(k)[codes[i]]
+        return out
+
+    def take(self, rows):
+        rows = np.asarray(rows, dtype=np.intp)
+        return FeatureTable(self.tickers[rows], self.last_dates[rows], {k: v[rows] for k, v in self.cols.items()},
+                            {k: v[rows] for k, v in self.codes.items()})
+
+    def select(self, tickers):
+        # rows for the given tickers, in that order, skipping tickers without features
+        return self.take([self.index[t] for t in tickers if t in self.index])
+
+    def with_columns(self, cols):
+        return FeatureTable(self.tickers, self.last_dates, dict(self.cols, **cols))
+
+    def to_dict(self):
+        return {r["ticker"]: r for r in self}
+
+    def to_frame(self):
+        df = pd.DataFrame({"ticker": self.tickers.astype(str), "last_date": self.last_dates.astype("datetime64[s]")})
+        for k, v in self.cols.items():
+            df[k] = v
+        for k, codes in self.codes.items():
+            df[k] = pd.Categorical.from_codes(codes, categories=list(self.categories(k)))
+        return df
+
+    def write(self, path):
+        # Parquet for .parquet paths, otherwise an uncompressed Arrow IPC file that readers can memory-map
+        pa = arrow_backend()
+        if pa is None:
+            return None
+        table = pa.Table.from_pandas(self.to_frame(), preserve_index=False)
+        tmp = path + ".tmp"
+        if path.endswith(".parquet"):
+            import pyarrow.parquet as pq
+            pq.write_table(table, tmp)
+        else:
+            with pa.OSFile(tmp, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp, path)
+        return path
+
+def timeframe_columns(tf_bars, symbols, frames=None):
+    # one panel pass over every resampled timeframe (and the daily bars when given),
+    # with each (timeframe, symbol) pair as its own right-aligned column
+    blocks = ([(None, None)] if frames is not None else []) + list(tf_bars.items())
+    closes = [frames[s]["Close"].to_numpy(dtype="float64") if tf is None else (bars[s][4] if s in bars else ())
+              for tf, bars in blocks for s in symbols]
+    mat = right_align(closes)
+    cols = panel_columns(mat)
+    bars = np.count_nonzero(~np.isnan(mat), axis=0)
+    n = len(symbols)
+    out = {}
+    for b, (tf, _) in enumerate(blocks):
+        part = slice(b * n, (b + 1) * n)
+        if tf is None:
+            out.update({k: v[part] for k, v in cols.items()})
+        else:
+            out.update(timeframe_fields(tf, {k: v[part] for k, v in cols.items()}, bars[part]))
+    return out
+
+def build_features_panel(frames, symbols=None, tf_bars=None):
+    symbols = [s for s in (symbols if symbols is not None else frames)
+               if s in frames and frames[s] is not None and len(frames[s]) >= 50]
+    if not symbols:
+        return FeatureTable([], [], {k: [] for k in FeatureTable.INDICATORS})
+    last_dates = [frames[s].index[-1] for s in symbols]
+    return FeatureTable(symbols, np.array(last_dates, dtype="datetime64[D]"),
+                        timeframe_columns(tf_bars or {}, symbols, frames))
+
+
+# Weekly/monthly bars resampled from the daily frames, so higher timeframes cost no downloads.
+# Resampling a symbol is a few reduceat calls, cheaper than reading a cached copy back from
+# disk, so bars are rebuilt every run; resumed runs get the finished features from the stage cache.
+TIMEFRAMES = ("wk", "mo")
+TF_FIELDS = {"sma20": "sma20", "sma50": "sma50", "rsi14": "rsi14", "macd": "macd",
+             "macd_signal": "macd_signal", "macd_hist": "macd_hist", "chg_1d": "chg"}
+TF_MACD_MIN_BARS = 26 + 9  # slow EMA plus signal; the monthly bars of a one-year window fall short
+
+def timeframe_fields(tf, cols, bars):
+    # panel_columns output as "<tf>_" columns; MACD over fewer than TF_MACD_MIN_BARS bars is
+    # mostly its EMA seed, so it is NaN there like the SMAs and RSI without enough bars
+    short = np.asarray(bars) < TF_MACD_MIN_BARS
+    out = {}
+    for k, name in TF_FIELDS.items():
+        out[f"{tf}_{name}"] = np.where(short, np.nan, cols[k]) if k.startswith("macd") else cols[k]
+    return out
+
+def candle_array(df):
+    # same (epoch day, O, H, L, C, V) x bars layout as the candle store
+    days = df.index.values.astype("datetime64[D]").astype("int64").astype("float64")
+    return np.vstack([days, df[OHLCV].to_numpy(dtype="float64").T])
+
+def period_ids(days, tf):
+    # calendar period of each epoch day: weeks ending Friday (pandas "W-FRI") or months
+    days = np.asarray(days).astype("int64")
+    if tf == "mo":
+        return days.astype("datetime64[D]").astype("datetime64[M]").astype("int64")
+    return (days - 2) // 7  # 1970-01-03 was a Saturday
+
+def resample_array(arr, tf):
+    # one bar per period, dated on the period's last trading day
+    if arr.shape[1] == 0:
+        return arr
+    p = period_ids(arr[0], tf)
+    starts = np.flatnonzero(np.r_[True, p[1:] != p[:-1]])
+    ends = np.r_[starts[1:], len(p)] - 1
+    return np.vstack([
+        arr[0][ends], arr[1][starts],
+        np.maximum.reduceat(arr[2], starts), np.minimum.reduceat(arr[3], starts),
+        arr[4][ends], np.add.reduceat(arr[5], starts),
+    ])
+
+def resample_bars(frames, symbols, timeframes=TIMEFRAMES):
+    # {timeframe: {symbol: bars in candle store layout}}
+    out = {tf: {} for tf in timeframes}
+    for s in symbols:
+        df = frames.get(s)
+        if df is None or df.empty:
             continue
-        for i, it in enumerate(items, 1):
-            news_lines.append(f"{t} NEWS{i}: {it.get('title','')} | {it.get('link','')}")
-    news_block = "- " + "\n- ".join(news_lines) if news_lines else "-"
+        cur = candle_array(df)
+        for tf in timeframes:
+            out[tf][s] = resample_array(cur, tf)
+    return out
+
+
+# Incremental indicators: per-symbol running state that absorbs one bar at a time in O(1)
+# and yields the dict build_features gives on the frame the run loaded. The state keeps its
+# own history while the store trims the frame to the lookback window: price, SMAs, changes
+# and the 52-week range only look at the bars still in the frame and match exactly, while
+# the EMAs behind RSI and MACD keep the seed of the state's first bar. That seed's weight
+# decays as (1 - alpha)^bars, below 1e-8 once the frame holds a year of bars (trimming only
+# starts then), so those values agree with a full recompute to within EMA_TOLERANCE.
+class IndicatorState:
+    SMA_WINDOWS = (20, 50, 200)
+    HIGH_LOW_WINDOW = 252
+    EMA_TOLERANCE = 1e-6  # relative to price for MACD values, to the 0..100 range for RSI
+
+    def __init__(self, ticker):
+        self.ticker = ticker
+        self.last_date = None
+        self.n = 0
+        self.span = 0  # trailing bars of the state that are in the current frame
+        self.n_delta = 0
+        self.closes = deque(maxlen=max(self.SMA_WINDOWS) + 1)
+        self.sums = {w: 0.0 for w in self.SMA_WINDOWS}
+        self.ema = {"up": math.nan, "down": math.nan, "fast": math.nan, "slow": math.nan, "signal": math.nan}
+        self.maxq = deque()
+        self.minq = deque()
+
+    def _ewm(self, key, com, x):
+        # same recursion as pandas .ewm(com=..., adjust=False).mean()
+        alpha = 1.0 / (1.0 + com)
+        w = self.ema[key]
+        if math.isnan(w):
+            w = x
+        elif w != x:
+            w = ((1.0 - alpha) * w + alpha * x) / ((1.0 - alpha) + alpha)
+        self.ema[key] = w
+        return w
+
+    def update(self, date, close):
+        close = float(close)
+        if self.closes:
+            delta = close - self.closes[-1]
+            self.n_delta += 1
+            self._ewm("up", 1.0 / (1.0 / 14) - 1.0, max(delta, 0.0))
+            self._ewm("down", 1.0 / (1.0 / 14) - 1.0, -min(delta, 0.0))
+        fast = self._ewm("fast", (12 - 1) / 2.0, close)
+        slow = self._ewm("slow", (26 - 1) / 2.0, close)
+        self._ewm("signal", (9 - 1) / 2.0, fast - slow)
+
+        self.closes.append(close)
+        self.n += 1
+        for w in self.SMA_WINDOWS:
+            self.sums[w] += close
+            if self.n > w:
+                self.sums[w] -= self.closes[-w - 1]
+
+        i = self.n - 1
+        while self.maxq and self.maxq[-1][1] <= close:
+            self.maxq.pop()
+        self.maxq.append((i, close))
+        while self.maxq[0][0] <= i - self.HIGH_LOW_WINDOW:
+            self.maxq.popleft()
+        while self.minq and self.minq[-1][1] >= close:
+            self.minq.pop()
+        self.minq.append((i, close))
+        while self.minq[0][0] <= i - self.HIGH_LOW_WINDOW:
+            self.minq.popleft()
+        self.last_date = pd.Timestamp(date).strftime("%Y-%m-%d")
+        self.span += 1
+
+    def catch_up(self, df):
+        # feed the bars after last_date; False when the frame no longer agrees with the state
+        # or reaches further back than the bars the state still tracks
+        if self.last_date is None or df.empty:
+            return False
+        last = pd.Timestamp(self.last_date)
+        if last not in df.index or float(df["Close"].loc[last]) != self.closes[-1]:
+            return False
+        new = df[df.index > last]
+        if len(df) - len(new) > self.span:
+            return False
+        for date, close in zip(new.index, new["Close"].to_numpy(dtype="float64")):
+            self.update(date, close)
+        self.trim(len(df))
+        return True
+
+    def trim(self, span):
+        # forget bars the store has dropped from the front of the frame
+        self.span = min(self.span, span)
+        oldest = self.n - min(self.span, self.HIGH_LOW_WINDOW)
+        while self.maxq[0][0] < oldest:
+            self.maxq.popleft()
+        while self.minq[0][0] < oldest:
+            self.minq.popleft()
+
+    @classmethod
+    def from_frame(cls, ticker, df):
+        st = cls(ticker)
+        for date, close in zip(df.index, df["Close"].to_numpy(dtype="float64")):
+            st.update(date, close)
+        return st
+
+    def features(self):
+        m = self.span
+        if m < 50:
+            return None
+        price = self.closes[-1]
+        out = {"ticker": self.ticker, "last_date": self.last_date, "price": price}
+        for w in self.SMA_WINDOWS:
+            out[f"sma{w}"] = self.sums[w] / w if m >= w else np.nan
+        up, down = self.ema["up"], self.ema["down"]
+        if min(self.n_delta, m - 1) < 14:
+            out["rsi14"] = np.nan
+        elif down == 0:
+            out["rsi14"] = np.nan if up == 0 else 100.0
+        else:
+            out["rsi14"] = 100 - (100 / (1 + up / down))
+        out["macd"] = self.ema["fast"] - self.ema["slow"]
+        out["macd_signal"] = self.ema["signal"]
+        out["macd_hist"] = out["macd"] - out["macd_signal"]
+        for p in (1, 5, 20):
+            out[f"chg_{p}d"] = price / self.closes[-1 - p] - 1 if m > p else np.nan
+        out["high_52w"] = self.maxq[0][1]
+        out["low_52w"] = self.minq[0][1]
+        return label_features(out)
+
+    def to_dict(self):
+        return {
+            "ticker": self.ticker, "last_date": self.last_date,
+            "n": self.n, "n_delta": self.n_delta, "span": self.span,
+            "closes": list(self.closes), "sums": {str(w): v for w, v in self.sums.items()},
+            "ema": self.ema, "maxq": list(self.maxq), "minq": list(self.minq),
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        st = cls(d["ticker"])
+        st.last_date = d["last_date"]
+        st.n = int(d["n"])
+        st.span = int(d.get("span", d["n"]))
+        st.n_delta = int(d["n_delta"])
+        st.closes.extend(d["closes"])
+        st.sums = {int(w): float(v) for w, v in d["sums"].items()}
+        st.ema = {k: float(v) for k, v in d["ema"].items()}
+        st.maxq = deque((int(i), float(v)) for i, v in d["maxq"])
+        st.minq = deque((int(i), float(v)) for i, v in d["minq"])
+        return st
+
+def state_path(state_dir, symbol):
+    return os.path.join(state_dir, re.sub(r"[^A-Za-z0-9._-]", "_", symbol) + ".json")
+
+def load_indicator_state(state_dir, symbol):
+    path = state_path(state_dir, symbol)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return IndicatorState.from_dict(json.load(f))
+    except Exception as e:
+        print(f"[Indicators] unreadable state {path}: {e}")
+        return None
+
+def save_indicator_state(state_dir, st):
+    ensure_dir(state_dir)
+    path = state_path(state_dir, st.ticker)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(st.to_dict(), f)
+    os.replace(path + ".tmp", path)
+
+def build_features_incremental(frames, symbols, state_dir):
+    out = {}
+    rebuilt = 0
+    for s in symbols:
+        df = frames.get(s)
+        if df is None or df.empty:
+            continue
+        st = load_indicator_state(state_dir, s)
+        if st is None or not st.catch_up(df):
+            st = IndicatorState.from_frame(s, df)
+            rebuilt += 1
+        try:
+            save_indicator_state(state_dir, st)
+        except Exception as e:
+            print(f"[Indicators] cannot write state for {s}: {e}")
+        f = st.features()
+        if f:
+            out[s] = f
+    print(f"[Indicators] {len(out)} symbols ({rebuilt} rebuilt from history)")
+    return out
+
+
+# Screening: rank the watchlist on cheap technical criteria and only send the top K to the
+# model. Each criterion scores 0..1 per ticker and the score is their weighted sum.
+SCREEN_WEIGHTS = {"rsi_extreme": 1.0, "macd_cross": 1.0, "near_high": 0.5, "volume_spike": 1.0}
+
+def volume_ratio(frames, symbols, window=20):
+    # last bar's volume over the average of the `window` bars before it
+    vol = align_panel(frames, symbols, "Volume")
+    if vol.shape[0] <= window:
+        return np.full(len(symbols), np.nan)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return vol[-1] / vol[-1 - window:-1].mean(axis=0)
+
+def macd_crossed(frames, symbols, bars=3):
+    # True where the MACD histogram changed sign within the last `bars` bars
+    _, _, hist = macd_panel(align_panel(frames, symbols, "Close"), 12, 26, 9)
+    sign = np.sign(hist[-bars - 1:])
+    return ((sign[1:] * sign[:-1]) < 0).any(axis=0)
+
+def screen_scores(table, frames, weights=None, cross_bars=3, volume_window=20):
+    weights = SCREEN_WEIGHTS if weights is None else weights
+    symbols = table.tickers.tolist()
+    c = table.cols
+    parts = {
+        "rsi_extreme": np.clip((np.abs(c["rsi14"] - 50) - 10) / 20, 0, 1),
+        "macd_cross": macd_crossed(frames, symbols, cross_bars).astype("float64"),
+        "near_high": np.clip(1 + c["off_high_52w_pct"] / 0.2, 0, 1),
+        "volume_spike": np.clip((volume_ratio(frames, symbols, volume_window) - 1) / 2, 0, 1),
+    }
+    total = np.zeros(len(symbols))
+    for k, w in weights.items():
+        if w and k in parts:
+            total += w * np.nan_to_num(parts[k], nan=0.0)
+    return total
+
+def screen_top_k(table, frames, cfg_screen):
+    # (selected tickers in watchlist order, {ticker: score})
+    if not len(table):
+        return [], {}
+    scores = screen_scores(table, frames, cfg_screen.get("weights"),
+                           int(cfg_screen.get("cross_bars", 3)), int(cfg_screen.get("volume_window", 20)))
+    symbols = table.tickers.tolist()
+    k = int(cfg_screen.get("top_k", 25))
+    keep = np.zeros(len(symbols), dtype=bool)
+    if k >= len(symbols):
+        keep[:] = True
+    elif k > 0:
+        keep[np.argpartition(-scores, k - 1)[:k]] = True
+    for t in cfg_screen.get("always") or []:
+        if t in table.index:
+            keep[table.index[t]] = True
+    return [s for s, kept in zip(symbols, keep) if kept], dict(zip(symbols, np.round(scores, 4).tolist()))
+
+
+# Cross-asset: correlation, beta and relative strength of every ticker against every overview
+# symbol (indices, commodities, fx) over the trailing `window` bars. Returns sit on the shared
+# dates x symbols matrix and each pair only counts the days both sides traded, so the whole
+# tickers x factors grid comes out of a few masked matrix products instead of a loop over pairs.
+CROSS_FIELDS = ("corr", "beta", "rs")
+
+def return_panel(frames, symbols, window):
+    # (window x symbols) daily log returns over the last window+1 dates any symbol traded,
+    # NaN where either bar is missing; only each symbol's own last window+1 bars can land there
+    tails = [(frames[s].index[-(window + 1):].values.astype("datetime64[D]"),
+              frames[s]["Close"].to_numpy(dtype="float64")[-(window + 1):]) for s in symbols]
+    dates = np.unique(np.concatenate([d for d, _ in tails]))[-(window + 1):]
+    close = np.full((len(dates), len(symbols)), np.nan)
+    for j, (d, c) in enumerate(tails):
+        keep = d >= dates[0]
+        close[np.searchsorted(dates, d[keep]), j] = c[keep]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.log(close[1:] / close[:-1])
+
+def cross_asset_columns(frames, tickers, factors, window=60, min_obs=40):
+    # {"x_<factor>_<corr|beta|rs>": per-ticker array}; pairs with fewer than min_obs shared days are NaN
+    tickers = list(tickers)
+    factors = [s for s in factors if frames.get(s) is not None and not frames[s].empty]
+    if not tickers or not factors:
+        return {}
+    have = [t for t in tickers if frames.get(t) is not None and not frames[t].empty]
+    ret = return_panel(frames, have + factors, window)
+    x = np.full((ret.shape[0], len(tickers)), np.nan)
+    pos = {t: i for i, t in enumerate(tickers)}
+    x[:, [pos[t] for t in have]] = ret[:, :len(have)]
+    return cross_asset_stats(x, ret[:, len(have):], factors, min_obs)
+
+def return_history(frames, symbols):
+    # (dates, {symbol: column}, log returns) over the whole history on the union of trading
+    # dates; row i is the return into dates[i + 1]
+    index, symbols, mats = date_panel(frames, symbols, ("Close",))
+    close = mats["Close"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ret = np.log(close[1:] / close[:-1])
+    return index.values.astype("datetime64[D]"), {s: j for j, s in enumerate(symbols)}, ret
+
+def cross_asset_asof(history, tickers, factors, date, window=60, min_obs=40):
+    # cross_asset_columns as a live run on `date` computes them, from one return_history
+    dates, cols, ret = history
+    factors = [s for s in factors if s in cols]
+    if not len(tickers) or not factors:
+        return {}
+    k = int(np.searchsorted(dates, np.datetime64(date, "D"), side="right")) - 1
+    rows = slice(max(k - window, 0), max(k, 0))
+    x = np.full((rows.stop - rows.start, len(tickers)), np.nan)
+    have = [i for i, t in enumerate(tickers) if t in cols]
+    x[:, have] = ret[rows][:, [cols[tickers[i]] for i in have]]
+    return cross_asset_stats(x, ret[rows][:, [cols[s] for s in factors]], factors, min_obs)
+
+def cross_asset_stats(x, y, factors, min_obs):
+    # masked moment sums over (bars x tickers) and (bars x factors) return matrices
+    mx, my = ~np.isnan(x), ~np.isnan(y)
+    x0, y0 = np.where(mx, x, 0.0), np.where(my, y, 0.0)
+    wx, wy = mx.astype("float64"), my.astype("float64")
+    n = wx.T @ wy
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sx, sy = x0.T @ wy, wx.T @ y0
+        cov = x0.T @ y0 - sx * sy / n
+        var_x = (x0 * x0).T @ wy - sx * sx / n
+        var_y = wx.T @ (y0 * y0) - sy * sy / n
+        corr = np.clip(cov / np.sqrt(var_x * var_y), -1.0, 1.0)
+        beta = cov / var_y
+        # the ticker's growth over the window relative to the factor's
+        rs = np.exp(np.nansum(x, axis=0)[:, None] - np.nansum(y, axis=0)[None, :]) - 1.0
+    short = n < min_obs
+    corr[short] = np.nan
+    beta[short] = np.nan
+    rs[(mx.sum(axis=0) < min_obs)[:, None] | (my.sum(axis=0) < min_obs)[None, :]] = np.nan
+    mats = {"corr": corr, "beta": beta, "rs": rs}
+    return {f"x_{s}_{name}": mats[name][:, j] for j, s in enumerate(factors) for name in CROSS_FIELDS}
+
+def cross_asset_items(f):
+    # [(factor, corr, beta, rs)] from a feature row, in column order
+    return [(k[2:-5], f[k], f[k[:-4] + "beta"], f[k[:-4] + "rs"])
+            for k in f if k.startswith("x_") and k.endswith("_corr")]
+
+def cross_asset_text(f):
+    parts = [f"{s} corr={c:.2f} beta={b:.2f} rs={fmt_pct(r, 1)}"
+             for s, c, b, r in cross_asset_items(f) if not math.isnan(c)]
+    return ", ".join(parts) or None
+
+
+PROMPT_VERSION = "3"
+TF_NAMES = {"wk": "W", "mo": "M"}
+
+def timeframe_text(f, tf):
+    # compact weekly/monthly summary; indicators and labels without enough bars are left out
+    p = f"{tf}_"
+    if f.get(p + "chg") is None:
+        return None
+    parts = []
+    if not math.isnan(f[p + "chg"]):
+        parts.append(f"chg={fmt_pct(f[p + 'chg'])}")
+    if not math.isnan(f[p + "sma20"]):
+        parts.append(f"SMA20/50={fmt_price(f[p + 'sma20'])}/{fmt_price(f[p + 'sma50'])}")
+    if not math.isnan(f[p + "rsi14"]):
+        parts.append(f"RSI14={f[p + 'rsi14']:.1f}({f[p + 'rsi_state']})")
+    if not math.isnan(f[p + "macd"]):
+        parts.append(f"MACD={f[p + 'macd']:.3f}/{f[p + 'macd_signal']:.3f}({f[p + 'macd_state']})")
+    if not math.isnan(f[p + "sma20"]):
+        parts.append(f"trend={f[p + 'trend_sma']}")
+    return " ".join(parts) or None
+
+def feature_line(f):
+    line = (
+        f"{f['ticker']} price={fmt_price(f['price'])} 1d={fmt_pct(f['chg_1d'])} 5d={fmt_pct(f['chg_5d'])} 20d={fmt_pct(f['chg_20d'])} "
+        f"SMA20/50/200={fmt_price(f['sma20'])}/{fmt_price(f['sma50'])}/{fmt_price(f['sma200'])} "
+        f"RSI14={f['rsi14']:.1f}({f['rsi_state']}) MACD={f['macd']:.3f}/{f['macd_signal']:.3f}({f['macd_state']}) "
+        f"52wH/L={fmt_price(f['high_52w'])}/{fmt_price(f['low_52w'])} offHigh={fmt_pct(f['off_high_52w_pct'])}"
+    )
+    extra = [f"{TF_NAMES[tf]}: {text}" for tf in TIMEFRAMES for text in [timeframe_text(f, tf)] if text]
+    cross = cross_asset_text(f)
+    if cross:
+        extra.append(f"X: {cross}")
+    return "; ".join([line] + extra)
+
+def news_lines_for(ticker, items):
+    return [f"{ticker} NEWS{i}: {it.get('title','')} | {it.get('link','')}" for i, it in enumerate(items or [], 1)]
+
+def system_prompt(config):
+    risk = config.get("risk_management", {})
+    dsl = risk.get("default_stop_loss_pct", 0.03)
+    dtp = risk.get("default_take_profit_pct", 0.06)
+    xwin = int(config.get("cross_asset", {}).get("window", 60))
 
     sys = (
         "You are a stock analyst. Based on the provided technical metrics and headlines, output STRICT JSON only.\n\n"
@@ -286,12 +1628,34 @@ def build_ai_prompt(config, market_overview, features_list, news_map):
         "}\n\n"
         "Rules:\n"
         "- ใช้ข้อมูล indicators (SMA/RSI/MACD/52w) + หัวข้อข่าวที่ให้มาเท่านั้น\n"
+        "- W:/M: คือ indicators บนแท่งรายสัปดาห์/รายเดือน ใช้ยืนยันแนวโน้มหลักเทียบกับสัญญาณรายวัน\n"
+        f"- X: คือ corr/beta ของผลตอบแทนรายวันเทียบกับดัชนี/น้ำมัน/ดอลลาร์ และ rs = ผลตอบแทนเทียบกับสินทรัพย์นั้น ย้อนหลัง {xwin} วัน\n"
         "- แยก positive_factors และ negative_factors อย่างละ ≥2 ข้อ ถ้าไม่พบให้ใช้ \"-\"\n"
         "- ใช้ภาษาไทย กระชับ ชัดเจน, หลีกเลี่ยงการแต่งข้อมูลเอง\n"
         f"- ถ้าไม่แน่ใจ SL/TP ให้ใช้ defaults: SL {dsl:.2%}, TP {dtp:.2%}\n"
         "- Output เป็น JSON ล้วน ไม่มี Markdown/โค้ดบล็อก\n"
     )
+    return sys
+
+def build_ai_prompt(config, market_overview, features_list, news_map):
+    tz = config.get("timezone", "Asia/Bangkok")
+    today = datetime.now(ZoneInfo(tz)).strftime("%Y-%m-%d")
+
+    overview_joined = "; ".join(
+        f"{k}:{item['ticker']} p={fmt_price(item['price'])} 1d={fmt_pct(item['chg_1d'])} rsi={item['rsi14']:.1f} trend={item['trend_sma']}"
+        for k, arr in market_overview.items() if arr
+        for item in arr
+    ) or "-"
+
+    feat_lines = [feature_line(f) for f in features_list]
+    feat_block = "- " + "\n- ".join(feat_lines) if feat_lines else "-"
+
+    news_lines = []
+    for t, items in news_map.items():
+        news_lines.extend(news_lines_for(t, items))
+    news_block = "- " + "\n- ".join(news_lines) if news_lines else "-"
 
+    sys = system_prompt(config)
     user = (
         f"วันที่: {today}\n\n"
         "ภาพรวมตลาด (ย่อ):\n"
@@ -307,16 +1671,32 @@ def build_ai_prompt(config, market_overview, features_list, news_map):
     )
     return sys, user
 
-def call_gemini(model_name, system_prompt, user_prompt):
-    key = os.getenv("GEMINI_API_KEY", "").strip()
-    if not key:
-        raise RuntimeError("Missing GEMINI_API_KEY")
-    if genai is None:
-        raise RuntimeError("google-generativeai not installed")
-    genai.configure(api_key=key)
-    model = genai.GenerativeModel(model_name)
-    resp = model.generate_content([{"role":"user","parts":[system_prompt + "\n\n" + user_prompt]}])
-    text = (resp.text or "").strip().strip("`")
+_GEMINI_MODELS = {}
+_GEMINI_LOCK = threading.Lock()
+
+def gemini_model(model_name):
+    # configure the client once per process and reuse one GenerativeModel per name
+    with _GEMINI_LOCK:
+        if model_name not in _GEMINI_MODELS:
+            key = os.getenv("GEMINI_API_KEY", "").strip()
+            if not key:
+                raise RuntimeError("Missing GEMINI_API_KEY")
+            genai = llm_backend()
+            if genai is None:
+                raise RuntimeError("google-generativeai not installed")
+            if not _GEMINI_MODELS:
+                genai.configure(api_key=key)
+            _GEMINI_MODELS[model_name] = genai.GenerativeModel(model_name)
+        return _GEMINI_MODELS[model_name]
+
+def llm_model(config):
+    if offline_mode(config):
+        from offline import FakeModel
+        return FakeModel()
+    return None
+
+def parse_model_json(text):
+    text = (text or "").strip().strip("`")
     try:
         return json.loads(text)
     except Exception:
@@ -325,28 +1705,343 @@ def call_gemini(model_name, system_prompt, user_prompt):
             return json.loads(m.group(0))
         raise
 
+def call_gemini(model_name, system_prompt, user_prompt, model=None):
+    model = model or gemini_model(model_name)
+    prompt = system_prompt + "\n\n" + user_prompt
+    with TRACER.span("call_gemini", model=model_name, prompt_bytes=len(prompt.encode("utf-8"))) as sp:
+        resp = upstream("gemini").call(model.generate_content, [{"role":"user","parts":[prompt]}])
+        sp["bytes"] = len((resp.text or "").encode("utf-8"))
+        return parse_model_json(resp.text)
+
+STANCES = ("Buy", "Sell", "Hold")
+
+def validate_ai_json(ai_json, tickers):
+    if not isinstance(ai_json, dict) or not isinstance(ai_json.get("tickers"), list):
+        return ["reply is not an object with a tickers list"]
+    problems = []
+    got = {}
+    for r in ai_json["tickers"]:
+        if isinstance(r, dict) and r.get("ticker"):
+            got[r["ticker"]] = r
+    for t in tickers:
+        r = got.get(t)
+        if r is None:
+            problems.append(f"{t}: missing")
+            continue
+        if r.get("stance") not in STANCES:
+            problems.append(f"{t}: bad stance {r.get('stance')!r}")
+        try:
+            ok = 0 <= float(r.get("confidence")) <= 100
+        except Exception:
+            ok = False
+        if not ok:
+            problems.append(f"{t}: bad confidence {r.get('confidence')!r}")
+    return problems
+
+def merge_ai_json(parts, date_str=None):
+    merged = {"date": date_str, "tickers": [], "notes": ""}
+    notes = []
+    for part in parts:
+        merged["date"] = merged["date"] or part.get("date")
+        merged["tickers"].extend(part.get("tickers", []))
+        if part.get("notes"):
+            notes.append(str(part["notes"]).strip())
+    merged["notes"] = "\n\n".join(dict.fromkeys(n for n in notes if n))
+    return merged
+
+def call_gemini_sharded(config, overview, features, news_map, model=None):
+    cfg = config.get("gemini", {})
+    model_name = config.get("gemini_model", "gemini-2.5-flash")
+    size = int(cfg.get("shard_size", 10)) or len(features) or 1
+    workers = max(1, int(cfg.get("max_workers", 4)))
+    retries = max(0, int(cfg.get("max_retries", 2)))
+    shards = [features[i:i + size] for i in range(0, len(features), size)]
+    if model is None:
+        model = gemini_model(model_name)
+
+    def run(shard, attempt):
+        names = [f["ticker"] for f in shard]
+        sys, usr = build_ai_prompt(config, overview, shard, {t: news_map.get(t, []) for t in names})
+        with TRACER.span("gemini_shard", symbols=len(names), retries=int(attempt > 0)):
+            res = call_gemini(model_name, sys, usr, model=model)
+        problems = validate_ai_json(res, names)
+        if problems:
+            raise ValueError("; ".join(problems[:5]))
+        keep = set(names)
+        res["tickers"] = [r for r in res["tickers"] if isinstance(r, dict) and r.get("ticker") in keep]
+        return res
+
+    results, pending, last_err = {}, list(range(len(shards))), None
+    for attempt in range(retries + 1):
+        with ThreadPoolExecutor(max_workers=min(workers, len(pending))) as pool:
+            futures = {i: pool.submit(run, shards[i], attempt) for i in pending}
+        failed = []
+        for i, fut in futures.items():
+            try:
+                results[i] = fut.result()
+            except Exception as e:
+                last_err = e
+                failed.append(i)
+                TRACER.count("gemini_shard_failures")
+                print(f"[Gemini] shard {i + 1}/{len(shards)} attempt {attempt + 1} failed: {e}")
+        pending = failed
+        if not pending:
+            break
+    if not results and last_err is not None:
+        raise last_err
+    for i in pending:
+        print(f"[Gemini] giving up on shard {i + 1}: {', '.join(f['ticker'] for f in shards[i])}")
+    return merge_ai_json([results[i] for i in sorted(results)])
+
+
+class LLMCache:
+    # per-ticker recommendations keyed by a hash of everything that went into the prompt for that ticker
+    def __init__(self, cache_dir, ttl_days=3, max_entries=5000):
+        self.dir = cache_dir
+        self.ttl = float(ttl_days) * 86400
+        self.max_entries = int(max_entries)
+        ensure_dir(cache_dir)
+
+    @staticmethod
+    def key(model_name, sys_prompt, feat_line, news_lines):
+        raw = json.dumps([PROMPT_VERSION, model_name, sys_prompt, feat_line, news_lines], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        path = os.path.join(self.dir, key + ".json")
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f).get("rec")
+        except Exception:
+            return None
+
+    def put(self, key, rec):
+        path = os.path.join(self.dir, key + ".json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"created_at": time.time(), "rec": rec}, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def put_latest(self, ticker, rec, date_str):
+        # last recommendation per ticker regardless of inputs, the fallback when the model is down
+        latest_dir = os.path.join(self.dir, "latest")
+        ensure_dir(latest_dir)
+        path = state_path(latest_dir, ticker)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"date": date_str, "rec": rec}, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def latest(self, ticker):
+        try:
+            with open(state_path(os.path.join(self.dir, "latest"), ticker), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            return dict(entry["rec"], stale=entry.get("date") or True)
+        except Exception:
+            return None
+
+    def evict(self):
+        files = sorted(
+            ((os.path.getmtime(os.path.join(self.dir, n)), os.path.join(self.dir, n))
+             for n in os.listdir(self.dir) if n.endswith(".json")),
+            reverse=True,
+        )
+        for k, (mtime, path) in enumerate(files):
+            if k >= self.max_entries or time.time() - mtime > self.ttl:
+                os.remove(path)
+
+def llm_cache(config):
+    cfg = config.get("llm_cache", {})
+    if not cfg.get("enable", True):
+        return None
+    try:
+        return LLMCache(cfg.get("dir", "data/llm_cache"), cfg.get("ttl_days", 3), cfg.get("max_entries", 5000))
+    except Exception as e:
+        print("[LLM cache] disabled:", e)
+        return None
+
+def call_gemini_cached(config, overview, features, news_map, model=None):
+    cache = llm_cache(config)
+    tz = config.get("timezone", "Asia/Bangkok")
+    today = datetime.now(ZoneInfo(tz)).strftime("%Y-%m-%d")
+    if cache is None:
+        return call_gemini_sharded(config, overview, features, news_map, model=model)
+    refresh = bool(config.get("llm_cache", {}).get("refresh", False)) or os.getenv("LLM_CACHE_REFRESH", "").strip() == "1"
+    model_name = config.get("gemini_model", "gemini-2.5-flash")
+    sys_prompt = system_prompt(config)
+    keys = {f["ticker"]: cache.key(model_name, sys_prompt, feature_line(f), news_lines_for(f["ticker"], news_map.get(f["ticker"], [])))
+            for f in features}
+    hits = {}
+    if not refresh:
+        for t, k in keys.items():
+            rec = cache.get(k)
+            if rec is not None:
+                hits[t] = rec
+    misses = [f for f in features if f["ticker"] not in hits]
+    print(f"[LLM cache] {len(hits)} hit(s), {len(misses)} to send{' (refresh)' if refresh else ''}")
+
+    fresh = {"date": today, "tickers": [], "notes": ""}
+    if misses:
+        try:
+            fresh = call_gemini_sharded(config, overview, misses, news_map, model=model)
+        except Exception as e:
+            print(f"[Gemini] unavailable ({type(e).__name__}: {e}); falling back to the last cached recommendations")
+            TRACER.fail(e)
+    new_recs = {r["ticker"]: r for r in fresh.get("tickers", []) if isinstance(r, dict) and r.get("ticker") in keys}
+    for t, rec in new_recs.items():
+        try:
+            cache.put(keys[t], rec)
+            cache.put_latest(t, rec, today)
+        except Exception as e:
+            print(f"[LLM cache] cannot store {t}: {e}")
+    try:
+        cache.evict()
+    except Exception as e:
+        print("[LLM cache] eviction failed:", e)
+    recs = []
+    for f in features:
+        rec = hits.get(f["ticker"]) or new_recs.get(f["ticker"])
+        if rec is None:
+            rec = cache.latest(f["ticker"])
+            if rec is not None:
+                TRACER.count("gemini_stale")
+        if rec:
+            recs.append(rec)
+    return {"date": fresh.get("date"), "tickers": recs, "notes": fresh.get("notes", "")}
+
+
+SMA_WINDOWS = (20, 50, 200)
+
+def sma_series_panel(frames, symbols, windows=SMA_WINDOWS):
+    # rolling SMAs for every symbol in one DataFrame.rolling call per window
+    symbols = [s for s in symbols if s in frames and not frames[s].empty]
+    if not symbols:
+        return {}
+    close = pd.DataFrame(align_panel(frames, symbols, "Close"), columns=symbols)
+    out = {s: {} for s in symbols}
+    for w in windows:
+        rolled = close.rolling(w).mean().to_numpy()
+        for j, s in enumerate(symbols):
+            out[s][w] = rolled[len(rolled) - len(frames[s]):, j]
+    return out
+
+_CHART_AXES = None
+
+def chart_axes():
+    # one Figure per process, cleared and reused for every chart
+    global _CHART_AXES
+    if _CHART_AXES is None:
+        fig = chart_backend()(figsize=(10, 4.5))
+        # fixed margins instead of tight_layout(), which costs an extra draw per chart
+        fig.subplots_adjust(left=0.07, right=0.965, bottom=0.08, top=0.92)
+        _CHART_AXES = (fig, fig.add_subplot())
+    fig, ax = _CHART_AXES
+    ax.clear()
+    return fig, ax
+
+def draw_chart(ticker, dates, close, smas, out_path):
+    fig, ax = chart_axes()
+    ax.plot(dates, close, label="Close")
+    for w in SMA_WINDOWS:
+        if w in smas and len(close) >= w:
+            ax.plot(dates, smas[w], label=f"SMA{w}")
+    ax.set_title(f"{ticker} — Price & SMA")
+    ax.legend()
+    fig.savefig(out_path)
 
-def plot_stock(ticker, df, out_path):
-    if plt is None or df.empty:
+def render_chart_job(job):
+    ticker, dates, close, smas, out_path = job
+    try:
+        draw_chart(ticker, dates, close, smas, out_path)
+        return out_path, True
+    except Exception as e:
+        print(f"[Charts] {ticker} failed: {e}")
+        return out_path, False
+
+def plot_stock(ticker, df, out_path, smas=None):
+    if df.empty or chart_backend() is None:
         return
+    if smas is None:
+        smas = {w: df["Close"].rolling(w).mean().to_numpy() for w in SMA_WINDOWS}
+    render_chart_job((ticker, df.index.to_numpy(), df["Close"].to_numpy(), smas, out_path))
+
+def chart_hash(job):
+    ticker, dates, close, smas, _ = job
+    h = hashlib.sha1(ticker.encode("utf-8"))
+    h.update(np.ascontiguousarray(dates).view("uint8"))
+    h.update(np.ascontiguousarray(close, dtype="float64").view("uint8"))
+    for w in sorted(smas):
+        h.update(np.ascontiguousarray(smas[w], dtype="float64").view("uint8"))
+    return h.hexdigest()
+
+def render_charts(frames, sma_map, tickers, out_dir, report_date, workers=4):
+    # the manifest maps ticker -> hash and PNG of its last chart, so an unchanged chart from an
+    # earlier day is copied instead of redrawn; entries whose PNG was deleted are dropped
+    manifest_path = os.path.join(out_dir, ".chart_hashes.json")
     try:
-        fig = plt.figure(figsize=(10, 4.5))
-        ax = plt.gca()
-        ax.plot(df.index, df["Close"], label="Close")
-        ax.plot(df.index, df["Close"].rolling(20).mean(), label="SMA20")
-        ax.plot(df.index, df["Close"].rolling(50).mean(), label="SMA50")
-        if len(df) >= 200:
-            ax.plot(df.index, df["Close"].rolling(200).mean(), label="SMA200")
-        ax.set_title(f"{ticker} — Price & SMA")
-        ax.legend()
-        fig.tight_layout()
-        fig.savefig(out_path)
-        plt.close(fig)
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
     except Exception:
-        pass
+        manifest = {}
+    manifest = {t: m for t, m in manifest.items()
+                if isinstance(m, dict) and os.path.exists(m.get("png", ""))}
+    jobs, pending, reused = [], {}, 0
+    for t in tickers:
+        df = frames.get(t)
+        if df is None or df.empty:
+            continue
+        out_png = os.path.join(out_dir, f"{report_date}_{t}.png")
+        smas = sma_map.get(t) or {w: df["Close"].rolling(w).mean().to_numpy() for w in SMA_WINDOWS}
+        job = (t, df.index.to_numpy(), df["Close"].to_numpy(dtype="float64"), smas, out_png)
+        h = chart_hash(job)
+        prev = manifest.get(t)
+        if prev and prev["hash"] == h:
+            try:
+                if os.path.abspath(prev["png"]) != os.path.abspath(out_png):
+                    shutil.copyfile(prev["png"], out_png)
+                manifest[t] = {"hash": h, "png": out_png}
+                reused += 1
+                continue
+            except OSError as e:
+                print(f"[Charts] cannot reuse {prev['png']}: {e}")
+        jobs.append(job)
+        pending[out_png] = (t, h)
+    done = []
+    if jobs:
+        workers = max(1, min(int(workers), len(jobs)))
+        if workers == 1:
+            done = [render_chart_job(j) for j in jobs]
+        else:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # this runs on a pipeline thread next to the news/llm threads; forking a threaded
+            # process can deadlock the child, so start workers from a clean server process
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method)) as pool:
+                done = list(pool.map(render_chart_job, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+    for path, ok in done:
+        t, h = pending[path]
+        if ok:
+            manifest[t] = {"hash": h, "png": path}
+        else:
+            manifest.pop(t, None)
+    try:
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=1)
+    except Exception as e:
+        print("[Charts] cannot write manifest:", e)
+    print(f"[Charts] rendered {sum(ok for _, ok in done)}, unchanged {reused}")
+
+
 def connect_google_sheet(json_keyfile: str, spreadsheet_id: str):
-    if gspread is None or ServiceAccountCredentials is None:
+    gspread, _ = sheets_backend()
+    if gspread is None:
         raise RuntimeError("gspread/oauth2client not installed")
+    with TRACER.span("connect_google_sheet"):
+        return _connect_google_sheet(json_keyfile, spreadsheet_id)
+
+def _connect_google_sheet(json_keyfile, spreadsheet_id):
+    gspread, ServiceAccountCredentials = sheets_backend()
     scope = ["https://spreadsheets.google.com/feeds","https://www.googleapis.com/auth/drive"]
     creds = ServiceAccountCredentials.from_json_keyfile_name(json_keyfile, scope)
     client = gspread.authorize(creds)
@@ -357,12 +2052,18 @@ def connect_google_sheet(json_keyfile: str, spreadsheet_id: str):
         ws = sh.sheet1
     return ws
 
-def export_to_sheet(ws, date_str, features, ai_json):
+def sheet_cell(x):
+    # the Sheets API rejects NaN in JSON payloads
+    return "" if isinstance(x, float) and math.isnan(x) else x
+
+def sheet_rows(date_str, features, ai_json, screened_out=()):
     rec_map = {t["ticker"]: t for t in ai_json.get("tickers", [])}
+    for t in screened_out:
+        rec_map.setdefault(t, {"stance": "screened out"})
     rows = []
     for f in features:
         r = rec_map.get(f["ticker"], {})
-        rows.append([
+        rows.append([sheet_cell(x) for x in (
             date_str,
             f["ticker"],
             f["price"],
@@ -372,14 +2073,124 @@ def export_to_sheet(ws, date_str, features, ai_json):
             f.get("sma50",""),
             "; ".join(r.get("positive_factors", []) or []),
             "; ".join(r.get("negative_factors", []) or []),
-        ])
-    ws.append_rows(rows, value_input_option="RAW")
+        )])
+    return rows
+
+def sheets_call(fn, *args, retries=5, backoff_sec=1.0, sleep=time.sleep, **kwargs):
+    # retry quota (429) and transient 5xx errors with jittered exponential backoff
+    for attempt in range(retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            status = http_status(e)
+            if attempt >= retries or status is None or not retryable(e):
+                raise
+            TRACER.count("sheets_retries")
+            TRACER.add("retries")
+            delay = backoff_delay(attempt, backoff_sec)
+            print(f"[Sheets] HTTP {status}, retrying in {delay:.1f}s ({attempt + 1}/{retries})")
+            sleep(delay)
+
+def a1_column(n):
+    name = ""
+    while n:
+        n, rem = divmod(n - 1, 26)
+        name = chr(65 + rem) + name
+    return name
+
+def upsert_rows(ws, rows, chunk_rows=1000, retries=5, backoff_sec=1.0, sleep=time.sleep):
+    # rows keyed on (date, ticker): existing rows are rewritten in place, new ones appended.
+    # One read of the key columns, then chunked batch_update/append_rows calls.
+    if not rows:
+        return {"updated": 0, "inserted": 0}
+    def call(fn, *args, **kwargs):
+        return sheets_call(fn, *args, retries=retries, backoff_sec=backoff_sec, sleep=sleep, **kwargs)
+
+    existing = call(ws.get_values, "A:B")
+    index = {}
+    for i, r in enumerate(existing, 1):
+        if len(r) >= 2:
+            index.setdefault((str(r[0]), str(r[1])), []).append(i)
+    latest = {}
+    for row in rows:
+        latest[(str(row[0]), str(row[1]))] = row
+    updates, inserts = [], []
+    for key, row in latest.items():
+        if key in index:
+            updates.extend((n, row) for n in index[key])
+        else:
+            inserts.append(row)
+
+    # consecutive sheet rows become one range, split so no request exceeds chunk_rows
+    updates.sort(key=lambda x: x[0])
+    width = max(len(r) for r in rows)
+    ranges = []
+    for n, row in updates:
+        if ranges and ranges[-1]["start"] + len(ranges[-1]["values"]) == n and len(ranges[-1]["values"]) < chunk_rows:
+            ranges[-1]["values"].append(row)
+        else:
+            ranges.append({"start": n, "values": [row]})
+    batch, size = [], 0
+    for rg in ranges + [None]:
+        if batch and (rg is None or size + len(rg["values"]) > chunk_rows):
+            call(ws.batch_update, batch, value_input_option="RAW")
+            batch, size = [], 0
+        if rg is not None:
+            end = rg["start"] + len(rg["values"]) - 1
+            batch.append({"range": f"A{rg['start']}:{a1_column(width)}{end}", "values": rg["values"]})
+            size += len(rg["values"])
+    for i in range(0, len(inserts), chunk_rows):
+        call(ws.append_rows, inserts[i:i + chunk_rows], value_input_option="RAW")
+    return {"updated": len(updates), "inserted": len(inserts)}
+
+def write_sheet_rows(ws, rows, cfg_sheets=None):
+    cfg = cfg_sheets or {}
+    retries, backoff = int(cfg.get("max_retries", 5)), float(cfg.get("backoff_sec", 1.0))
+    chunk = max(1, int(cfg.get("chunk_rows", 1000)))
+    if cfg.get("mode", "upsert") == "append":
+        for i in range(0, len(rows), chunk):
+            sheets_call(ws.append_rows, rows[i:i + chunk], value_input_option="RAW", retries=retries, backoff_sec=backoff)
+        return {"updated": 0, "inserted": len(rows)}
+    return upsert_rows(ws, rows, chunk_rows=chunk, retries=retries, backoff_sec=backoff)
 
-def render_report(date_str, overview, features, ai_json, news_map):
+def export_to_sheet(ws, date_str, features, ai_json, screened_out=(), cfg_sheets=None):
+    return write_sheet_rows(ws, sheet_rows(date_str, features, ai_json, screened_out), cfg_sheets)
+
+def stance_text(r):
+    stale = r.get("stale")
+    return f"{r.get('stance','-')} (stale {stale})" if stale else r.get("stance", "-")
+
+def cross_asset_section(features, window):
+    # tickers x factors table of "corr / beta / rs"; empty when the cross-asset columns are off
+    first = next(iter(features), None)
+    factors = [s for s, *_ in cross_asset_items(first)] if first else []
+    if not factors:
+        return []
+    md = [f"## ความสัมพันธ์ข้ามสินทรัพย์ (ย้อนหลัง {window} วัน)\n",
+          "*ค่าในแต่ละช่อง: corr / beta ของผลตอบแทนรายวัน / rs (ผลตอบแทนของหุ้นเทียบกับสินทรัพย์นั้น)*\n",
+          "| Ticker | " + " | ".join(f"`{s}`" for s in factors) + " |",
+          "|---|" + "---:|" * len(factors)]
+    for f in features:
+        cells = ["-" if math.isnan(c) else f"{c:.2f} / {b:.2f} / {fmt_pct(r, 1)}" for _, c, b, r in cross_asset_items(f)]
+        md.append(f"| `{f['ticker']}` | " + " | ".join(cells) + " |")
+    md.append("")
+    return md
+
+def render_report(date_str, overview, features, ai_json, news_map, screened_out=(), stale=None, cross_window=60):
+    # stale: {ticker: last bar date} for candles served from the store after a failed refresh
     rec_map = {t["ticker"]: t for t in ai_json.get("tickers", [])}
+    for t in screened_out:
+        rec_map.setdefault(t, {"stance": "screened out"})
+    stale = stale or {}
     md = []
     md.append(f"# Daily AI Stock Insight — {date_str}\n")
     md.append("> *รายงานอัตโนมัติจาก GitHub Actions + Yahoo Finance + Google News + Gemini — เพื่อการศึกษา ไม่ใช่คำแนะนำการลงทุน*\n")
+    if stale:
+        listed = ", ".join(f"`{t}` ({d})" for t, d in sorted(stale.items()))
+        md.append(f"> ⚠️ **ข้อมูลราคาไม่อัปเดต (stale):** ดึงข้อมูลจาก Yahoo ไม่สำเร็จ ใช้แท่งล่าสุดจากแคชแทน — {listed}\n")
+    stale_recs = sorted(t for t, r in rec_map.items() if r.get("stale"))
+    if stale_recs:
+        md.append(f"> ⚠️ **คำแนะนำจากแคช (stale):** เรียก Gemini ไม่สำเร็จ ใช้คำแนะนำล่าสุดที่เคยได้ — {', '.join(stale_recs)}\n")
     md.append("## ภาพรวมตลาด\n")
     def render_group(name, arr):
         if not arr: return
@@ -395,17 +2206,30 @@ def render_report(date_str, overview, features, ai_json, news_map):
     md.append("|---|---:|---:|---|---:|---|---:|")
     for f in features:
         r = rec_map.get(f["ticker"], {})
-        md.append(f"| `{f['ticker']}` | {fmt_price(f['price'])} | {fmt_pct(f['chg_1d'])} | {f['trend_sma']} | {f['rsi14']:.1f} | {r.get('stance','-')} | {r.get('confidence','-')} |")
+        mark = " ⚠️stale" if f["ticker"] in stale else ""
+        md.append(f"| `{f['ticker']}`{mark} | {fmt_price(f['price'])} | {fmt_pct(f['chg_1d'])} | {f['trend_sma']} | {f['rsi14']:.1f} | {stance_text(r)} | {r.get('confidence','-')} |")
     md.append("")
+    if screened_out:
+        md.append(f"*{len(screened_out)} ตัวไม่ผ่านการคัดกรองเบื้องต้น (screened out) จึงไม่ได้ส่งให้โมเดลวิเคราะห์*\n")
+    md.extend(cross_asset_section(features, cross_window))
     md.append("## แผนการเข้า-ออกต่อหุ้น (รายละเอียด)\n")
+    skip = set(screened_out)
     for f in features:
+        if f["ticker"] in skip:
+            continue
         r = rec_map.get(f["ticker"], {})
         md.append(f"### {f['ticker']}")
+        if f["ticker"] in stale:
+            md.append(f"- ⚠️ ราคาจากแคช (stale) แท่งล่าสุด {stale[f['ticker']]}")
         md.append(f"- ราคา: {fmt_price(f['price'])} | 1d {fmt_pct(f['chg_1d'])} | 5d {fmt_pct(f['chg_5d'])} | 20d {fmt_pct(f['chg_20d'])}")
         md.append(f"- SMA20/50/200: {fmt_price(f['sma20'])} / {fmt_price(f['sma50'])} / {fmt_price(f['sma200'])}")
         md.append(f"- RSI14: {f['rsi14']:.1f} ({f['rsi_state']}) | MACD: {f['macd']:.3f}/{f['macd_signal']:.3f} ({f['macd_state']})")
         md.append(f"- 52w: H {fmt_price(f['high_52w'])} / L {fmt_price(f['low_52w'])} | ห่าง 52wH: {fmt_pct(f['off_high_52w_pct'])}")
-        md.append(f"- **ข้อแนะนำ (Gemini):** {r.get('stance','-')} | ความเชื่อมั่น: {r.get('confidence','-')}")
+        for tf, name in (("wk", "รายสัปดาห์"), ("mo", "รายเดือน")):
+            text = timeframe_text(f, tf)
+            if text:
+                md.append(f"- {name}: {text}")
+        md.append(f"- **ข้อแนะนำ (Gemini):** {stance_text(r)} | ความเชื่อมั่น: {r.get('confidence','-')}")
         md.append(f"  - Entry: {r.get('entry_rule','-')} | ช่วงราคาเข้า: {r.get('entry_price_range','-')}")
         md.append(f"  - Stop Loss: {r.get('stop_loss','-')} | Take Profit: {r.get('take_profit','-')} | Timeframe: {r.get('timeframe','-')}")
         bullets = r.get("reasoning_bullets", [])
@@ -428,8 +2252,9 @@ def render_report(date_str, overview, features, ai_json, news_map):
                 link = it.get("link","").strip()
                 src = it.get("source","")
                 pub = it.get("published","")
-                if link: md.append(f"- [{title}]({link}) — {src} ({pub})")
-                else:    md.append(f"- {title} — {src} ({pub})")
+                flag = " ⚠️stale (แคช)" if it.get("stale") else ""
+                if link: md.append(f"- [{title}]({link}) — {src} ({pub}){flag}")
+                else:    md.append(f"- {title} — {src} ({pub}){flag}")
         md.append("")
     notes = ai_json.get("notes","")
     if notes:
@@ -439,91 +2264,565 @@ def render_report(date_str, overview, features, ai_json, news_map):
     md.append("**หมายเหตุ/ข้อจำกัด:** รายงานนี้สร้างโดยอัลกอริทึมและ LLM เพื่อการศึกษาเท่านั้น มิใช่คำแนะนำการลงทุน")
     return "\n".join(md)
 
-def to_overview_block(tickers, lookback_days, delay_sec=0.0):
+def to_overview_block(tickers, feature_map):
     arr = []
-    for t in tickers:
-        df = yahoo_candles(t, lookback_days)
-        if df.empty:
-            print(f"[overview] skip {t}: no data")
+    for t in tickers or []:
+        f = feature_map.get(t)
+        if f:
+            arr.append(f)
         else:
-            f = build_features(t, df)
-            if f: arr.append(f)
-        if delay_sec > 0:
-            time.sleep(delay_sec)
+            print(f"[overview] skip {t}: no data")
     return arr
 
-def main():
-    config = load_config("config.yml")
-    tz = config.get("timezone", "Asia/Bangkok")
-    now = datetime.now(ZoneInfo(tz))
-    if config.get("skip_if_weekend", True) and now.weekday() >= 5:
-        print("Weekend — skipped."); return
+# Backfill: features "as of" every trading day in a range, from one history load per symbol.
+# A live run whose Yahoo window ends (exclusive) on day d+1 sees the bars in
+# [d+1 - int(lookback_days*1.4) days, d]; each as-of window below reproduces exactly that.
+def asof_panel(df, asof_dates, lookback_days):
+    dates = df.index.values.astype("datetime64[D]")
+    close = df["Close"].to_numpy(dtype="float64")
+    span = np.timedelta64(int(lookback_days * 1.4), "D")
+    ends = np.asarray(asof_dates, dtype="datetime64[D]") + np.timedelta64(1, "D")
+    lo = np.searchsorted(dates, ends - span, side="left")
+    hi = np.searchsorted(dates, ends, side="left")
+    width = int((hi - lo).max()) if len(hi) else 0
+    src = hi[None, :] - width + np.arange(width)[:, None]
+    mat = np.where(src >= lo[None, :], close[np.clip(src, 0, max(len(close) - 1, 0))], np.nan)
+    return mat, hi - lo, hi
+
+def asof_resampled(df, counts, hi, tf):
+    # closes of the tf bars a live run resamples from each as-of window [hi - count, hi):
+    # whole periods are the same as in the full history, and the period holding the
+    # as-of day ends on that day's close
+    close = df["Close"].to_numpy(dtype="float64")
+    p = period_ids(df.index.values.astype("datetime64[D]").astype("int64"), tf)
+    change = p[1:] != p[:-1]
+    pos = np.r_[0, np.cumsum(change)]
+    period_close = close[np.r_[np.flatnonzero(change), len(p) - 1]]
+    last = hi - 1
+    first, top = pos[hi - counts], pos[last]
+    width = int((top - first).max()) + 1
+    src = top[None, :] - width + 1 + np.arange(width)[:, None]
+    mat = np.where(src >= first[None, :], period_close[np.clip(src, 0, len(period_close) - 1)], np.nan)
+    mat[-1] = close[last]
+    return mat
+
+def stack_right(blocks):
+    # side by side, bottom-aligned, NaN padding on top
+    width = max(b.shape[0] for b in blocks)
+    panel = np.full((width, sum(b.shape[1] for b in blocks)), np.nan)
+    col = 0
+    for b in blocks:
+        panel[width - b.shape[0]:, col:col + b.shape[1]] = b
+        col += b.shape[1]
+    return panel
+
+def backfill_features(frames, symbols, start, end, lookback_days, timeframes=TIMEFRAMES):
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    blocks, tf_blocks, meta = [], {tf: [] for tf in timeframes}, []
+    for s in symbols:
+        df = frames.get(s)
+        if df is None or df.empty:
+            continue
+        asof = df.index[(df.index >= start) & (df.index <= end)]
+        if len(asof) == 0:
+            continue
+        mat, counts, hi = asof_panel(df, asof, lookback_days)
+        blocks.append(mat)
+        for tf in timeframes:
+            tf_blocks[tf].append(asof_resampled(df, counts, hi, tf))
+        meta.extend((s, df.index[h - 1], n) for h, n in zip(hi, counts))
+    if not blocks:
+        return {}
+    cols = panel_columns(stack_right(blocks))
+    for tf in timeframes:
+        mat = stack_right(tf_blocks[tf])
+        cols.update(timeframe_fields(tf, panel_columns(mat), np.count_nonzero(~np.isnan(mat), axis=0)))
+    keep = np.array([n >= 50 for _, _, n in meta], dtype=bool)
+    table = FeatureTable([s for s, _, _ in meta], np.array([last for _, last, _ in meta], dtype="datetime64[D]"),
+                         cols).take(np.flatnonzero(keep))
+    days = np.datetime_as_string(table.last_dates, unit="D")
+    order = np.argsort(days, kind="stable")
+    bounds = np.flatnonzero(days[order][1:] != days[order][:-1]) + 1
+    return {str(days[g[0]]): table.take(g) for g in np.split(order, bounds) if len(g)}
+
+def run_backfill(config, start, end, export_sheet=False, out_dir="reports/backfill", ws=None):
+    configure_upstreams(config)
+    lookback = int(config.get("lookback_days", 260))
+    tickers = config.get("tickers") or []
+    groups = {k: config.get(k) or [] for k in ("indices", "commodities", "fx")}
+    symbols = list(dict.fromkeys(sum(groups.values(), []) + list(tickers)))
+    hist_start = (pd.Timestamp(start) + timedelta(days=1) - timedelta(days=int(lookback * 1.4))).date()
+    cfg_c = config.get("candles", {})
+    frames, _ = yahoo_candles_bulk(symbols, lookback, chunk_size=cfg_c.get("chunk_size", 50),
+                                   download=candle_downloader(config), start=hist_start)
+    cfg_tf = config.get("timeframes", {})
+    timeframes = [tf for tf in cfg_tf.get("list", TIMEFRAMES) if tf in TIMEFRAMES] if cfg_tf.get("enable", True) else []
+    by_date = backfill_features(frames, symbols, start, end, lookback, timeframes)
+    cfg_cross = config.get("cross_asset", {})
+    cross_window = int(cfg_cross.get("window", 60))
+    history = return_history(frames, symbols) if cfg_cross.get("enable", True) and by_date else None
+    ensure_dir(out_dir)
+    if export_sheet and ws is None:
+        sheet_id = os.getenv("SHEET_ID", "").strip()
+        if sheet_id and os.path.exists("gcp_service_account.json"):
+            ws = connect_google_sheet("gcp_service_account.json", sheet_id)
+        else:
+            print("Skip Google Sheet export (missing SHEET_ID or key file).")
+    rows = []
+    for date_str, fmap in by_date.items():
+        overview = {k: to_overview_block(v, fmap) for k, v in groups.items()}
+        features = fmap.select(tickers)
+        if not len(features):
+            continue
+        factors = [it["ticker"] for arr in overview.values() for it in arr]
+        if history is not None and factors:
+            features = features.with_columns(cross_asset_asof(
+                history, features.tickers.tolist(), factors, date_str, cross_window, int(cfg_cross.get("min_obs", 40))))
+        md = render_report(date_str, overview, features, {}, {}, cross_window=cross_window)
+        with open(os.path.join(out_dir, f"{date_str}.md"), "w", encoding="utf-8") as f:
+            f.write(md)
+        if ws is not None:
+            rows.extend(sheet_rows(date_str, features, {}))
+    print(f"Backfill generated: {len(by_date)} date(s) in {out_dir}")
+    if ws is not None and rows:
+        # one key read and a few large chunks for the whole range instead of a call per date
+        cfg_sheets = dict(config.get("sheets", {}))
+        cfg_sheets["chunk_rows"] = cfg_sheets.get("bulk_chunk_rows", 5000)
+        res = write_sheet_rows(ws, rows, cfg_sheets)
+        print(f"[Sheets] {res['updated']} row(s) updated, {res['inserted']} inserted")
+    return by_date
+
+# Backtest: rule-based stances from the trend/RSI/MACD labels, traded with SL/TP brackets
+# across all symbols at once on the dates x tickers matrices.
+def date_panel(frames, symbols, columns=("Close", "High", "Low")):
+    symbols = [s for s in symbols if s in frames and not frames[s].empty]
+    index = pd.DatetimeIndex(sorted(set().union(*(frames[s].index for s in symbols)))) if symbols else pd.DatetimeIndex([])
+    mats = {c: pd.DataFrame({s: frames[s][c] for s in symbols}).reindex(index).to_numpy(dtype="float64")
+            for c in columns}
+    return index, symbols, mats
+
+def stance_panel(close):
+    # +1 Buy / -1 Sell / 0 Hold per bar, from the same labels label_features() assigns
+    frame = pd.DataFrame(close)
+    sma50 = frame.rolling(50).mean().to_numpy()
+    sma200 = frame.rolling(200).mean().to_numpy()
+    rsi14 = rsi_panel(close, 14)
+    macd_line, signal_line, _ = macd_panel(close, 12, 26, 9)
+    with np.errstate(invalid="ignore"):
+        uptrend = (close > sma50) & (sma50 > np.where(np.isnan(sma200), -1e9, sma200))
+        bullish = macd_line > signal_line
+        buy = uptrend & bullish & ~(rsi14 >= 70)
+        sell = ~uptrend & ~bullish & ~(rsi14 <= 30)
+    stance = np.where(buy, 1, np.where(sell, -1, 0)).astype(np.int8)
+    stance[np.isnan(sma50) | np.isnan(close)] = 0
+    return stance
+
+def first_reach(paths, levels):
+    # paths: (E, H) rows non-decreasing; returns (E, L) index of the first bar >= each level (H if never)
+    e, h = paths.shape
+    offset = (np.abs(paths).max() + np.abs(levels).max() + 1.0) * 2.0
+    flat = (paths + offset * np.arange(e)[:, None]).ravel()
+    want = levels[None, :] + offset * np.arange(e)[:, None]
+    idx = np.searchsorted(flat, want.ravel(), side="left").reshape(e, len(levels))
+    return idx - h * np.arange(e)[:, None]
+
+def backtest_grid(close, high, low, stance, sl_values, tp_values, hold_days=20, onset_only=True):
+    sl_values = np.asarray(sl_values, dtype="float64")
+    tp_values = np.asarray(tp_values, dtype="float64")
+    t_n = close.shape[0]
+    signal = stance.copy()
+    if onset_only:
+        prev = np.vstack([np.zeros((1, stance.shape[1]), dtype=stance.dtype), stance[:-1]])
+        signal[signal == prev] = 0
+    signal[max(t_n - hold_days, 0):] = 0
+    t_idx, j_idx = np.nonzero(signal)
+    direction = signal[t_idx, j_idx].astype("float64")
+    entry = close[t_idx, j_idx]
+    rows = t_idx[:, None] + 1 + np.arange(hold_days)[None, :]
+    hi = high[rows, j_idx[:, None]] / entry[:, None] - 1
+    lo = low[rows, j_idx[:, None]] / entry[:, None] - 1
+    final = close[t_idx + hold_days, j_idx] / entry - 1
+    ok = np.isfinite(entry) & np.isfinite(hi).all(1) & np.isfinite(lo).all(1) & np.isfinite(final)
+    t_idx, direction, hi, lo, final = t_idx[ok], direction[ok], hi[ok], lo[ok], final[ok]
+    shape = (len(sl_values), len(tp_values))
+    res = {k: np.zeros(shape) for k in ("trades", "tp_rate", "sl_rate", "win_rate", "mean_ret", "total_ret", "max_dd")}
+    res["trades"][:] = len(t_idx)
+    if not len(t_idx):
+        return res
+    long = direction > 0
+    adverse = np.maximum.accumulate(np.where(long[:, None], -lo, hi), axis=1)
+    favour = np.maximum.accumulate(np.where(long[:, None], hi, -lo), axis=1)
+    timeout = direction * final
+    sl_at = first_reach(adverse, sl_values)
+    tp_at = first_reach(favour, tp_values)
+
+    # trades sorted by entry bar so each day's mean return is one reduceat per SL level
+    order = np.argsort(t_idx, kind="stable")
+    days, starts, counts = np.unique(t_idx[order], return_index=True, return_counts=True)
+    for i, sl in enumerate(sl_values):
+        s_hit = sl_at[:, i:i + 1] < hold_days
+        hit_sl = s_hit & (sl_at[:, i:i + 1] <= tp_at)  # same-bar ties count as the stop
+        hit_tp = (tp_at < hold_days) & ~hit_sl
+        ret = np.where(hit_sl, -sl, np.where(hit_tp, tp_values[None, :], timeout[:, None]))
+        res["tp_rate"][i] = hit_tp.mean(0)
+        res["sl_rate"][i] = hit_sl.mean(0)
+        res["win_rate"][i] = (ret > 0).mean(0)
+        res["mean_ret"][i] = ret.mean(0)
+        res["total_ret"][i] = ret.sum(0)
+        daily = np.add.reduceat(ret[order], starts, axis=0) / counts[:, None]
+        equity = np.cumsum(daily, axis=0)
+        res["max_dd"][i] = (np.maximum.accumulate(np.maximum(equity, 0), axis=0) - equity).max(0)
+    return res
+
+def run_backtest(config, out_dir="reports"):
+    cfg = config.get("backtest", {})
+    risk = config.get("risk_management", {})
+    hold = int(cfg.get("hold_days", 20))
+    steps = int(cfg.get("grid_steps", 40))
+    sl_values = np.unique(np.append(np.linspace(cfg.get("sl_min", 0.01), cfg.get("sl_max", 0.10), steps),
+                                    risk.get("default_stop_loss_pct", 0.03)))
+    tp_values = np.unique(np.append(np.linspace(cfg.get("tp_min", 0.02), cfg.get("tp_max", 0.20), steps),
+                                    risk.get("default_take_profit_pct", 0.06)))
+    tickers = config.get("tickers") or []
+    start = (datetime.now(timezone.utc) - timedelta(days=int(cfg.get("history_days", 1500)))).date()
+    frames, _ = yahoo_candles_bulk(tickers, 0, chunk_size=config.get("candles", {}).get("chunk_size", 50),
+                                   download=candle_downloader(config), start=start)
+    index, symbols, mats = date_panel(frames, tickers)
+    if not symbols:
+        print("Backtest: no candles."); return None
+    t0 = time.time()
+    stance = stance_panel(mats["Close"])
+    res = backtest_grid(mats["Close"], mats["High"], mats["Low"], stance, sl_values, tp_values, hold,
+                        onset_only=cfg.get("onset_only", True))
+    elapsed = time.time() - t0
+
+    i0 = int(np.searchsorted(sl_values, risk.get("default_stop_loss_pct", 0.03)))
+    j0 = int(np.searchsorted(tp_values, risk.get("default_take_profit_pct", 0.06)))
+    flat = [
+        {"sl": float(sl), "tp": float(tp), **{k: float(v[i, j]) for k, v in res.items()}}
+        for i, sl in enumerate(sl_values) for j, tp in enumerate(tp_values)
+    ]
+    flat.sort(key=lambda r: r["mean_ret"], reverse=True)
+    default = {"sl": float(sl_values[i0]), "tp": float(tp_values[j0]), **{k: float(v[i0, j0]) for k, v in res.items()}}
+    summary = {
+        "generated": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "symbols": symbols, "first_date": str(index[0].date()), "last_date": str(index[-1].date()),
+        "hold_days": hold, "combos": len(flat), "seconds": round(elapsed, 3),
+        "default": default, "top": flat[:20],
+    }
+    ensure_dir(out_dir)
+    stamp = datetime.now(ZoneInfo(config.get("timezone", "Asia/Bangkok"))).strftime("%Y-%m-%d")
+    with open(os.path.join(out_dir, f"backtest_{stamp}.json"), "w", encoding="utf-8") as f:
+        json.dump({**summary, "grid": flat}, f, indent=1)
+    md = [f"# Backtest — {stamp}\n",
+          f"{len(symbols)} symbols, {summary['first_date']} → {summary['last_date']}, hold ≤ {hold} bars, "
+          f"{len(flat)} SL/TP combos in {elapsed:.2f}s\n",
+          "| SL | TP | Trades | TP hit | SL hit | Win | Mean ret | Total ret | Max DD |",
+          "|---:|---:|---:|---:|---:|---:|---:|---:|---:|"]
+    for r in [default] + flat[:10]:
+        md.append(f"| {fmt_pct(r['sl'], 1)} | {fmt_pct(r['tp'], 1)} | {int(r['trades'])} | {fmt_pct(r['tp_rate'], 1)} | "
+                  f"{fmt_pct(r['sl_rate'], 1)} | {fmt_pct(r['win_rate'], 1)} | {fmt_pct(r['mean_ret'])} | "
+                  f"{fmt_pct(r['total_ret'], 1)} | {fmt_pct(r['max_dd'], 1)} |")
+    md.append("\nแถวแรกคือ SL/TP ตั้งต้นจาก `risk_management` ที่เหลือเรียงตามผลตอบแทนเฉลี่ยต่อเทรด")
+    with open(os.path.join(out_dir, f"backtest_{stamp}.md"), "w", encoding="utf-8") as f:
+        f.write("\n".join(md))
+    print(f"Backtest generated: {len(flat)} combos over {len(symbols)} symbols in {elapsed:.2f}s")
+    return summary
+
+# Pipeline as a stage DAG: each stage starts as soon as its inputs are ready, a failed
+# stage only takes down the stages that depend on it, and cacheable stage outputs can be
+# reloaded to resume a run.
+class Stage:
+    # complete(out) -> False keeps a degraded output (stale fallbacks, no model answer) out of
+    # the stage cache, so --resume retries the upstream instead of replaying the fallback
+    def __init__(self, name, fn, deps=(), cache=False, complete=None):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.cache = cache
+        self.complete = complete
+
+def run_stages(stages, workers=4, cache_dir=None, resume=False, profiles=None):
+    # profiles: a list to collect one cProfile.Profile per stage. cProfile only sees the thread
+    # that enabled it, so each stage is profiled on its own pool thread, and the stages run one
+    # at a time because Python 3.12+ allows a single active profiler per interpreter
+    from concurrent.futures import wait, FIRST_COMPLETED
+    by_name = {st.name: st for st in stages}
+    results, status = {}, {}
+    if profiles is not None:
+        workers = 1
+
+    def execute(st):
+        path = os.path.join(cache_dir, f"{st.name}.pkl") if cache_dir and st.cache else None
+        if resume and path and os.path.exists(path):
+            with open(path, "rb") as f:
+                out = pickle.load(f)
+            print(f"[Pipeline] {st.name}: resumed from {path}")
+            return out
+        with TRACER.span(f"stage:{st.name}") as sp:
+            kwargs = {d: results[d] for d in st.deps}
+            if profiles is None:
+                out = st.fn(**kwargs)
+            else:
+                prof = cProfile.Profile()
+                try:
+                    out = prof.runcall(st.fn, **kwargs)
+                finally:
+                    profiles.append(prof)
+            if isinstance(out, dict):
+                sp["symbols"] = len(out.get("features", out.get("tickers", out)))
+        if path and st.complete is not None and not st.complete(out):
+            print(f"[Pipeline] {st.name}: degraded output, not cached")
+        elif path:
+            try:
+                ensure_dir(cache_dir)
+                with open(path + ".tmp", "wb") as f:
+                    pickle.dump(out, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(path + ".tmp", path)
+            except Exception as e:
+                print(f"[Pipeline] cannot cache {st.name}: {e}")
+        return out
+
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        while len(status) < len(stages):
+            for st in stages:
+                if st.name in status or st.name in running.values():
+                    continue
+                dep_states = [status.get(d) for d in st.deps]
+                if any(s in ("failed", "skipped") for s in dep_states):
+                    status[st.name] = "skipped"
+                    print(f"[Pipeline] {st.name}: skipped (upstream failed)")
+                elif all(s == "done" for s in dep_states):
+                    running[pool.submit(execute, st)] = st.name
+            if not running:
+                break
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for fut in finished:
+                name = running.pop(fut)
+                try:
+                    results[name] = fut.result()
+                    status[name] = "done"
+                except Exception as e:
+                    status[name] = "failed"
+                    print(f"[Pipeline] {name} failed: {type(e).__name__}: {e}")
+    for name in by_name:
+        status.setdefault(name, "skipped")
+    return results, status
+
+def run_daily(config, now, resume=False, profiles=None):
+    configure_upstreams(config)
     lookback = int(config.get("lookback_days", 260))
-    tickers = config.get("tickers")
+    tickers = list(config.get("tickers") or [])
     indices = config.get("indices")
     commodities = config.get("commodities")
     fx = config.get("fx")
     cfg_news = config.get("news", {"enable": True, "lookback_days": 2, "per_ticker": 3})
-    delay = float(config.get("per_call_delay_sec", 0.0))
     locale_news = config.get("google_news_locale", {"hl":"en-US","gl":"US","ceid":"US:en"})
-    overview = {
-        "indices": to_overview_block(indices, lookback, delay_sec=delay),
-        "commodities": to_overview_block(commodities, lookback, delay_sec=delay),
-        "fx": to_overview_block(fx, lookback, delay_sec=delay),
-    }
-    features = []
-    hist_cache = {}
-    for t in tickers:
-        df = yahoo_candles(t, lookback)
-        hist_cache[t] = df
-        f = build_features(t, df) if not df.empty else None
-        if f: features.append(f)
-        if delay > 0:
-            time.sleep(delay)
-    if not features:
+    cfg_pipe = config.get("pipeline", {})
+    report_date = now.strftime("%Y-%m-%d")
+    symbols = list(indices or []) + list(commodities or []) + list(fx or []) + tickers
+    charts_on = config.get("charts", {}).get("enable", True)
+    cfg_table = config.get("feature_table", {})
+    cfg_screen = config.get("screen", {})
+    cfg_cross = config.get("cross_asset", {})
+    cross_window = int(cfg_cross.get("window", 60))
+    screen_on = bool(cfg_screen.get("enable", True)) and len(tickers) > int(cfg_screen.get("top_k", 25))
+
+    def candles():
+        frames, _ = load_candles(symbols, lookback, config, download=candle_downloader(config))
+        return frames
+
+    def features(candles):
+        cfg_ind = config.get("indicators", {})
+        cfg_tf = config.get("timeframes", {})
+        tf_bars = {}
+        if cfg_tf.get("enable", True):
+            tf_bars = resample_bars(candles, symbols, [tf for tf in cfg_tf.get("list", TIMEFRAMES) if tf in TIMEFRAMES])
+        if cfg_ind.get("incremental", False):
+            feature_map = FeatureTable.from_dicts(
+                build_features_incremental(candles, symbols, cfg_ind.get("state_dir", "data/indicators")).values())
+            if tf_bars and len(feature_map):
+                feature_map = feature_map.with_columns(timeframe_columns(tf_bars, feature_map.tickers.tolist()))
+        else:
+            feature_map = build_features_panel(candles, symbols, tf_bars)
+        overview = {
+            "indices": to_overview_block(indices, feature_map),
+            "commodities": to_overview_block(commodities, feature_map),
+            "fx": to_overview_block(fx, feature_map),
+        }
+        stale = {s: candles[s].index[-1].strftime("%Y-%m-%d") for s in symbols
+                 if s in candles and candles[s].attrs.get("stale") and s in feature_map}
+        table = feature_map.select(tickers)
+        factors = [it["ticker"] for arr in overview.values() for it in arr]
+        if cfg_cross.get("enable", True) and factors and len(table):
+            with TRACER.span("cross_asset", symbols=len(table) * len(factors)):
+                table = table.with_columns(cross_asset_columns(
+                    candles, table.tickers.tolist(), factors, cross_window, int(cfg_cross.get("min_obs", 40))))
+        return {"overview": overview, "features": table, "stale": stale, "cross_window": cross_window}
+
+    def screen(candles, features):
+        table = features["features"]
+        if not screen_on:
+            return {"tickers": table.tickers.tolist(), "screened_out": [], "scores": {}}
+        selected, scores = screen_top_k(table, candles, cfg_screen)
+        keep = set(selected)
+        out = [t for t in table.tickers.tolist() if t not in keep]
+        print(f"[Screen] {len(selected)} of {len(table)} tickers selected for the model")
+        return {"tickers": selected, "screened_out": out, "scores": scores}
+
+    def news(screen=None):
+        # without screening it only needs the ticker names, so it runs alongside the candle download
+        if not cfg_news.get("enable", True):
+            return {}
+        names = screen["tickers"] if screen is not None else tickers
+        queries = {t: COMPANY_NAME.get(t, t) for t in names}
+        return fetch_news_map(queries, cfg_news, locale_news, session=news_session(config))
+
+    def llm(features, news, screen):
+        chosen = features["features"].select(screen["tickers"])
+        if not len(chosen):
+            return {}
+        have = set(screen["tickers"])
+        try:
+            return call_gemini_cached(config, features["overview"], chosen,
+                                      {t: v for t, v in news.items() if t in have}, model=llm_model(config))
+        except Exception as e:
+            # the report still goes out with the features and headlines, just without recommendations
+            print(f"[Gemini] no recommendations this run: {type(e).__name__}: {e}")
+            TRACER.fail(e)
+            return {"tickers": [], "notes": ""}
+
+    def charts(candles):
+        if chart_backend() is None:
+            return
+        hist_cache = {t: candles.get(t, pd.DataFrame()) for t in tickers}
         ensure_dir("reports")
-        report_date = now.strftime("%Y-%m-%d")
-        msg = ("# Daily AI Stock Insight — {d}\n\n"
-               "ไม่สามารถโหลดข้อมูลจาก Yahoo Finance ได้ในรอบนี้ (เน็ตขัดข้อง/สัญลักษณ์ผิดพลาด).").format(d=report_date)
-        open(f"reports/{report_date}.md","w",encoding="utf-8").write(msg)
-        open("reports/latest.md","w",encoding="utf-8").write(msg)
-        print("Report generated (empty)."); return
-    news_map = {}
-    if cfg_news.get("enable", True):
-        per_ticker = int(cfg_news.get("per_ticker", 3))
-        lb_days = int(cfg_news.get("lookback_days", 2))
-        for f in features:
-            t = f["ticker"]
-            q = COMPANY_NAME.get(t, t)
-            items = google_news_company(q, lookback_days=lb_days, limit=per_ticker, locale=locale_news)
-            news_map[t] = items
-            if delay > 0:
-                time.sleep(delay)
-    sys, usr = build_ai_prompt(config, overview, features, news_map)
-    model_name = config.get("gemini_model", "gemini-2.5-flash")
-    ai_json = call_gemini(model_name, sys, usr)
+        render_charts(hist_cache, sma_series_panel(hist_cache, tickers), tickers, "reports", report_date,
+                      workers=config.get("charts", {}).get("max_workers", 4))
+
+    def report(features, news, llm, screen):
+        ensure_dir("reports")
+        if not features["features"]:
+            md = ("# Daily AI Stock Insight — {d}\n\n"
+                  "ไม่สามารถโหลดข้อมูลจาก Yahoo Finance ได้ในรอบนี้ (เน็ตขัดข้อง/สัญลักษณ์ผิดพลาด).").format(d=report_date)
+        else:
+            have = {f["ticker"] for f in features["features"]}
+            md = render_report(report_date, features["overview"], features["features"], llm,
+                               {t: v for t, v in news.items() if t in have}, screen["screened_out"],
+                               features.get("stale"), features.get("cross_window", 60))
+        with open(f"reports/{report_date}.md","w",encoding="utf-8") as f: f.write(md)
+        with open("reports/latest.md","w",encoding="utf-8") as f: f.write(md)
+        print("Report generated:", report_date if features["features"] else f"{report_date} (empty)")
+
+    def feature_file(features):
+        if not len(features["features"]):
+            return
+        ext = "parquet" if cfg_table.get("format", "arrow") == "parquet" else "arrow"
+        ensure_dir("reports")
+        path = features["features"].write(f"reports/{report_date}_features.{ext}")
+        if path:
+            shutil.copyfile(path, f"reports/latest_features.{ext}")
+            print("Feature table written:", path)
+
+    def sheets(features, llm, screen):
+        sheet_id = os.getenv("SHEET_ID", "").strip()
+        if not features["features"]:
+            return
+        if not (sheet_id and os.path.exists("gcp_service_account.json")):
+            print("Skip Google Sheet export (missing SHEET_ID or key file).")
+            return
+        ws = connect_google_sheet("gcp_service_account.json", sheet_id)
+        res = export_to_sheet(ws, report_date, features["features"], llm, screen["screened_out"], config.get("sheets"))
+        print(f"[Sheets] {res['updated']} row(s) updated, {res['inserted']} inserted")
+        print("Exported to Google Sheet")
+
+    def fresh_candles(frames):
+        return not any(df.attrs.get("stale") for df in frames.values())
+
+    def fresh_features(out):
+        return not out["stale"]
+
+    def fresh_news(news_map):
+        return not any(it.get("stale") for items in news_map.values() for it in items)
+
+    def fresh_llm(ai_json):
+        return not ai_json or (bool(ai_json.get("tickers")) and not any(r.get("stale") for r in ai_json["tickers"]))
+
+    stages = [
+        Stage("candles", candles, cache=True, complete=fresh_candles),
+        # once screening can drop tickers, only fetch headlines for the ones that made the cut
+        Stage("news", news, ["screen"] if screen_on else [], cache=True, complete=fresh_news),
+        Stage("features", features, ["candles"], cache=True, complete=fresh_features),
+        Stage("screen", screen, ["candles", "features"]),
+        Stage("llm", llm, ["features", "news", "screen"], cache=True, complete=fresh_llm),
+        Stage("report", report, ["features", "news", "llm", "screen"]),
+        Stage("sheets", sheets, ["features", "llm", "screen"]),
+    ]
+    if charts_on:
+        stages.insert(3, Stage("charts", charts, ["candles"]))
+    if cfg_table.get("export", False):
+        stages.append(Stage("feature_file", feature_file, ["features"]))
+    resume = resume or bool(cfg_pipe.get("resume", False)) or os.getenv("RESUME", "").strip() == "1"
+    stage_dir = cfg_pipe.get("stage_dir", "data/stages")
+    cache_dir = os.path.join(stage_dir, report_date)
+    if os.path.isdir(stage_dir):
+        for old in sorted(os.listdir(stage_dir))[:-7]:
+            shutil.rmtree(os.path.join(stage_dir, old), ignore_errors=True)
+    _, status = run_stages(stages, workers=int(cfg_pipe.get("max_workers", 4)), cache_dir=cache_dir,
+                           resume=resume, profiles=profiles)
+    failed = [n for n, s in status.items() if s != "done"]
+    if failed:
+        print("[Pipeline] not completed:", ", ".join(f"{n} ({status[n]})" for n in failed))
+    return status
+
+def main(config=None, resume=False):
+    config = config or load_config("config.yml")
+    tz = config.get("timezone", "Asia/Bangkok")
+    now = datetime.now(ZoneInfo(tz))
+    if config.get("skip_if_weekend", True) and now.weekday() >= 5:
+        print("Weekend — skipped."); return
     report_date = now.strftime("%Y-%m-%d")
-    ensure_dir("reports")
-    if config.get("charts", {}).get("enable", True) and plt is not None:
-        for t in tickers:
-            df = hist_cache.get(t)
-            if df is None or df.empty: continue
-            out_png = f"reports/{report_date}_{t}.png"
-            plot_stock(t, df, out_png)
-    md = render_report(report_date, overview, features, ai_json, news_map)
-    with open(f"reports/{report_date}.md","w",encoding="utf-8") as f: f.write(md)
-    with open("reports/latest.md","w",encoding="utf-8") as f: f.write(md)
-    print("Report generated:", report_date)
-    sheet_id = os.getenv("SHEET_ID", "").strip()
-    if sheet_id and os.path.exists("gcp_service_account.json"):
+    TRACER.reset()
+    profiles = None
+    if config.get("profile", False) or os.getenv("PROFILE", "").strip() == "1":
+        profiles = []
+    try:
+        with TRACER.span("pipeline"):
+            run_daily(config, now, resume=resume, profiles=profiles)
+    finally:
+        ensure_dir("reports")
+        if profiles:
+            stats = pstats.Stats(profiles[0])
+            for prof in profiles[1:]:
+                stats.add(prof)
+            prof_path = f"reports/{report_date}_profile.prof"
+            stats.dump_stats(prof_path)
+            stats.sort_stats("cumulative").print_stats(15)
+            print("Profile written:", prof_path)
         try:
-            ws = connect_google_sheet("gcp_service_account.json", sheet_id)
-            export_to_sheet(ws, report_date, features, ai_json)
-            print("Exported to Google Sheet")
+            TRACER.write(f"reports/{report_date}_trace.json")
+            print(TRACER.table())
         except Exception as e:
-            print("Google Sheet export failed:", e)
-    else:
-        print("Skip Google Sheet export (missing SHEET_ID or key file).")
+            print("Trace export failed:", e)
 
 if __name__ == "__main__":
-    main()
+    import argparse
+    parser = argparse.ArgumentParser(description="Daily AI Stock Insight")
+    parser.add_argument("--resume", action="store_true", help="reuse today's cached stage outputs")
+    sub = parser.add_subparsers(dest="command")
+    bf = sub.add_parser("backfill", help="regenerate reports (without the LLM) for past dates")
+    bf.add_argument("--start", required=True, help="first as-of date, YYYY-MM-DD")
+    bf.add_argument("--end", default=None, help="last as-of date, YYYY-MM-DD (default: --start)")
+    bf.add_argument("--sheet", action="store_true", help="also export the rows to Google Sheets")
+    bf.add_argument("--out", default="reports/backfill")
+    bt = sub.add_parser("backtest", help="backtest the rule-based stances with SL/TP brackets")
+    bt.add_argument("--out", default="reports")
+    args = parser.parse_args()
+    if args.command == "backfill":
+        run_backfill(load_config("config.yml"), args.start, args.end or args.start,
+                     export_sheet=args.sheet, out_dir=args.out)
+    elif args.command == "backtest":
+        run_backtest(load_config("config.yml"), out_dir=args.out)
+    else:
+        main(resume=args.resume)
@@ -0,0 +1,280 @@
+import zlib
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+# Offline stand-ins for the network backends used by main.py.
+# Everything here is deterministic per symbol so runs can be compared.
+
+OHLCV = ["Open", "High", "Low", "Close", "Volume"]
+
+
+def _seed(*parts):
+    return zlib.crc32("|".join(str(p) for p in parts).encode("utf-8"))
+
+def synthetic_candles(symbol, start=None, end=None, bars=None):
+    end = pd.Timestamp(end or datetime.now(timezone.utc).date())
+    if start is None:
+        start = end - timedelta(days=int((bars or 260) * 1.45))
+    # yfinance treats `end` as exclusive
+    idx = pd.bdate_range(pd.Timestamp(start), end - timedelta(days=1))
+    if bars:
+        idx = idx[-bars:]
+    if len(idx) == 0:
+        return pd.DataFrame(columns=OHLCV)
+    # a fixed anchor keeps the same date at the same price regardless of the window asked for
+    anchor = pd.Timestamp("2000-01-03")
+    rng = np.random.default_rng(_seed(symbol))
+    span = (idx[-1] - anchor).days // 7 * 5 + 10
+    steps = rng.normal(0.0001, 0.015, size=span)
+    pos = np.clip(((idx - anchor).days // 7 * 5 + idx.dayofweek).to_numpy(), 0, span - 1)
+    base = 20 + _seed(symbol, "px") % 400
+    close = base * np.exp(np.cumsum(steps)[pos])
+    wiggle = np.abs(np.random.default_rng(_seed(symbol, "hl")).normal(0, 0.01, size=span))[pos]
+    open_ = close * (1 + np.random.default_rng(_seed(symbol, "o")).normal(0, 0.005, size=span)[pos])
+    high = np.maximum(open_, close) * (1 + wiggle)
+    low = np.minimum(open_, close) * (1 - wiggle)
+    vol = (1e6 + _seed(symbol, "v") % 5e7) * np.exp(np.random.default_rng(_seed(symbol, "vol")).normal(0, 0.3, size=span))[pos]
+    return pd.DataFrame({"Open": open_, "High": high, "Low": low, "Close": close, "Volume": vol.round()}, index=idx)
+
+def synthetic_download(tickers, start=None, end=None, missing=(), **kwargs):
+    if isinstance(tickers, str):
+        tickers = tickers.split()
+    parts = {}
+    for t in tickers:
+        if t in missing:
+            continue
+        parts[t] = synthetic_candles(t, start, end)
+    if not parts:
+        return pd.DataFrame()
+    # same (ticker, field) column layout as yf.download(..., group_by="ticker")
+    return pd.concat(parts, axis=1)
+
+class Faults:
+    # deterministic fault schedule for the stand-ins below. Call n (1-based) fails when
+    # n <= fail_first or n is a multiple of fail_every, and sleeps slow_sec first when it is
+    # a multiple of slow_every; hang=True never answers at all.
+    def __init__(self, fail_first=0, fail_every=0, status=503, slow_every=0, slow_sec=0.0, hang=False):
+        import threading
+        self.fail_first = fail_first
+        self.fail_every = fail_every
+        self.status = status
+        self.slow_every = slow_every
+        self.slow_sec = slow_sec
+        self.hang = hang
+        self.calls = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def before(self):
+        import time
+        with self.lock:
+            self.calls += 1
+            n = self.calls
+        if self.hang:
+            time.sleep(3600)
+        if self.slow_every and n % self.slow_every == 0:
+            time.sleep(self.slow_sec)
+        if n <= self.fail_first or (self.fail_every and n % self.fail_every == 0):
+            with self.lock:
+                self.failures += 1
+            raise FakeAPIError(self.status)
+
+
+def make_download(missing=(), fail=False, faults=None):
+    def download(tickers, start=None, end=None, **kwargs):
+        if fail:
+            raise ConnectionError("offline stub: batch failed")
+        if faults:
+            faults.before()
+        return synthetic_download(tickers, start, end, missing=missing, **kwargs)
+    return download
+
+
+_HEADLINES = [
+    "{name} shares rise after analyst upgrade",
+    "{name} unveils new product roadmap",
+    "{name} stock slips as investors weigh guidance",
+    "{name} signs multi-year supply agreement",
+    "{name} faces regulatory scrutiny over pricing",
+    "{name} beats quarterly revenue estimates",
+]
+# shared market headlines so overlapping queries return duplicate items
+_MARKET_HEADLINES = [
+    "Chip stocks rally as AI spending outlook improves",
+    "Wall Street closes higher ahead of Fed minutes",
+    "Tech shares mixed as Treasury yields climb",
+]
+
+def synthetic_rss(query_text, limit=3):
+    from xml.sax.saxutils import escape
+    name = query_text.split(" when:")[0]
+    rng = np.random.default_rng(_seed(query_text, datetime.now(timezone.utc).date()))
+    titles = [h.format(name=name) for h in rng.permutation(_HEADLINES)[:max(limit, 1)]]
+    titles.insert(1, _MARKET_HEADLINES[_seed(name) % len(_MARKET_HEADLINES)])
+    pub = datetime.now(timezone.utc).strftime("%a, %d %b %Y 00:00:00 GMT")
+    items = []
+    for i, title in enumerate(titles):
+        slug = _seed(title)
+        items.append(
+            f"<item><title>{escape(title)} - Example Wire</title>"
+            f"<link>https://news.example.com/articles/{slug}?oc={i}</link>"
+            f"<pubDate>{pub}</pubDate>"
+            f'<source url="https://news.example.com">Example Wire</source></item>'
+        )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>'
+        f"<title>{escape(query_text)} - Google News</title>{''.join(items)}</channel></rss>"
+    ).encode("utf-8")
+
+
+class FakeResponse:
+    def __init__(self, content=b"", status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise FakeAPIError(self.status_code)
+
+
+class FakeNewsSession:
+    # stands in for requests.Session when fetching Google News RSS
+    def __init__(self, latency=0.0, faults=None):
+        self.latency = latency
+        self.faults = faults
+        self.requests = 0
+        self.not_modified = 0
+
+    def get(self, url, timeout=None, headers=None, **kwargs):
+        from urllib.parse import urlparse, parse_qs
+        import time
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.faults:
+            try:
+                self.faults.before()
+            except FakeAPIError as e:
+                return FakeResponse(b"", e.response.status_code)
+        query = parse_qs(urlparse(url).query).get("q", [""])[0]
+        body = synthetic_rss(query)
+        etag = f'"{_seed(body)}"'
+        if (headers or {}).get("If-None-Match") == etag:
+            self.not_modified += 1
+            return FakeResponse(b"", 304, {"ETag": etag})
+        return FakeResponse(body, 200, {"ETag": etag})
+
+
+class FakeReply:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModel:
+    # stands in for google.generativeai.GenerativeModel; answers from the tickers in the prompt
+    def __init__(self, latency=0.0, bad_every=0, faults=None):
+        import threading
+        self.latency = latency
+        self.bad_every = bad_every
+        self.faults = faults
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def generate_content(self, contents):
+        import json, re, time
+        with self.lock:
+            self.calls += 1
+            n = self.calls
+        if self.latency:
+            time.sleep(self.latency)
+        if self.faults:
+            self.faults.before()
+        prompt = contents[0]["parts"][0] if isinstance(contents, list) else str(contents)
+        if self.bad_every and n % self.bad_every == 0:
+            return FakeReply('{"tickers": [ truncated')
+        tickers = re.findall(r"^- ([A-Za-z0-9.^=\-]+) price=", prompt, flags=re.MULTILINE)
+        date = re.search(r"\d{4}-\d{2}-\d{2}", prompt)
+        recs = []
+        for t in tickers:
+            m = re.search(rf"^- {re.escape(t)} .*?RSI14=([\d.]+).*?\((Bullish|Bearish)\)", prompt, flags=re.MULTILINE)
+            rsi = float(m.group(1)) if m else 50.0
+            bull = bool(m) and m.group(2) == "Bullish"
+            stance = "Sell" if rsi >= 70 else ("Buy" if bull and rsi < 65 else "Hold")
+            recs.append({
+                "ticker": t, "stance": stance, "confidence": int(40 + _seed(t, date and date.group(0)) % 50),
+                "entry_rule": "-", "entry_price_range": "-", "stop_loss": "3%", "take_profit": "6%",
+                "timeframe": "days", "reasoning_bullets": [f"RSI14 {rsi:.1f}"],
+                "positive_factors": ["-"], "negative_factors": ["-"], "news_refs": [],
+            })
+        body = {"date": date.group(0) if date else "", "tickers": recs, "notes": "offline fake model"}
+        return FakeReply(json.dumps(body, ensure_ascii=False))
+
+
+class FakeAPIError(Exception):
+    # shaped like gspread.exceptions.APIError: the HTTP status is on .response.status_code
+    def __init__(self, status_code=429):
+        super().__init__(f"HTTP {status_code}")
+        self.response = FakeResponse(b"", status_code)
+
+
+class FakeWorksheet:
+    # in-memory stand-in for a gspread Worksheet; quota_every=n fails every n-th call with a 429
+    def __init__(self, rows=None, quota_every=0):
+        self.rows = [list(r) for r in rows or []]
+        self.calls = 0
+        self.quota_every = quota_every
+        self.quota_errors = 0
+
+    def _call(self):
+        self.calls += 1
+        if self.quota_every and self.calls % self.quota_every == 0:
+            self.quota_errors += 1
+            raise FakeAPIError(429)
+
+    def append_rows(self, values, value_input_option="RAW", **kwargs):
+        self._call()
+        self.rows.extend([list(r) for r in values])
+
+    def get_all_values(self):
+        self._call()
+        return [[("" if v is None else str(v)) for v in r] for r in self.rows]
+
+    def get_values(self, range_name=None, **kwargs):
+        import re
+        self._call()
+        cols = None
+        if range_name:
+            m = re.fullmatch(r"([A-Z]+):([A-Z]+)", range_name)
+            cols = (_col_index(m.group(1)), _col_index(m.group(2)) + 1)
+        rows = [r[cols[0]:cols[1]] if cols else r for r in self.rows]
+        return [[("" if v is None else str(v)) for v in r] for r in rows]
+
+    def update(self, values=None, range_name=None, **kwargs):
+        self._call()
+        self._write(range_name, values)
+
+    def batch_update(self, data, **kwargs):
+        self._call()
+        for d in data:
+            self._write(d["range"], d["values"])
+
+    def _write(self, range_name, values):
+        import re
+        m = re.fullmatch(r"([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?", range_name)
+        col, row = _col_index(m.group(1)), int(m.group(2)) - 1
+        for i, vals in enumerate(values):
+            while len(self.rows) <= row + i:
+                self.rows.append([])
+            r = self.rows[row + i]
+            r.extend([""] * (col + len(vals) - len(r)))
+            r[col:col + len(vals)] = list(vals)
+
+
+def _col_index(letters):
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch) - 64
+    return n - 1
@@ -0,0 +1,44 @@
+import numpy as np
+
+import main
+import offline
+
+
+def panel(symbols, bars):
+    frames = {s: offline.synthetic_candles(s, bars=bars) for s in symbols}
+    _, _, m = main.date_panel(frames, symbols)
+    return m["Close"], m["High"], m["Low"]
+
+
+def test_history_shorter_than_hold_days_has_no_trades():
+    close, high, low = panel(["AAA", "BBB"], 15)
+    stance = np.ones(close.shape, dtype=np.int8)
+    res = main.backtest_grid(close, high, low, stance, [0.02, 0.05], [0.04, 0.1], hold_days=20)
+    assert (res["trades"] == 0).all()
+
+
+def test_grid_matches_trade_by_trade_replay():
+    close, high, low = panel(["AAA", "BBB", "CCC"], 400)
+    stance = main.stance_panel(close)
+    sl, tp, hold = np.array([0.02, 0.05]), np.array([0.03, 0.08]), 10
+    res = main.backtest_grid(close, high, low, stance, sl, tp, hold)
+    prev = np.vstack([np.zeros((1, stance.shape[1]), stance.dtype), stance[:-1]])
+    signal = np.where(stance != prev, stance, 0)
+    signal[len(close) - hold:] = 0
+    for i, s in enumerate(sl):
+        for j, t in enumerate(tp):
+            rets = []
+            for bar, k in zip(*np.nonzero(signal)):
+                d, e, out = signal[bar, k], close[bar, k], None
+                for h in range(1, hold + 1):
+                    up, down = high[bar + h, k] / e - 1, low[bar + h, k] / e - 1
+                    stop, take = (-down >= s, up >= t) if d > 0 else (up >= s, -down >= t)
+                    if stop:
+                        out = -s
+                        break
+                    if take:
+                        out = t
+                        break
+                rets.append(d * (close[bar + hold, k] / e - 1) if out is None else out)
+            assert res["trades"][i, j] == len(rets)
+            assert abs(res["mean_ret"][i, j] - np.mean(rets)) < 1e-12
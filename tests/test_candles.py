@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+
+import main
+import offline
+
+LOOKBACK = 260
+
+
+class RecordingDownload:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, tickers, start=None, end=None, **kwargs):
+        self.calls.append((list(tickers), start))
+        return offline.synthetic_download(tickers, start, end)
+
+
+def store_config(tmp_path):
+    return {"candles": {"store_dir": str(tmp_path / "candles"), "overlap_bars": 5}, "per_call_delay_sec": 0}
+
+
+def test_second_run_only_fetches_the_gap(tmp_path):
+    config = store_config(tmp_path)
+    window_start, _ = main.candle_window(LOOKBACK)
+    first_dl, again_dl = RecordingDownload(), RecordingDownload()
+    first, _ = main.load_candles(["AAA", "BBB"], LOOKBACK, config, download=first_dl)
+    assert first_dl.calls == [(["AAA", "BBB"], window_start.isoformat())]
+    again, _ = main.load_candles(["AAA", "BBB"], LOOKBACK, config, download=again_dl)
+    (tickers, start), = again_dl.calls
+    assert sorted(tickers) == ["AAA", "BBB"]
+    assert start == first["AAA"].index[-5].date().isoformat()
+    for s in ("AAA", "BBB"):
+        pd.testing.assert_frame_equal(again[s], first[s], check_freq=False)
+
+
+def test_restated_history_forces_a_full_refresh(tmp_path):
+    config = store_config(tmp_path)
+    store_dir = config["candles"]["store_dir"]
+    window_start, _ = main.candle_window(LOOKBACK)
+    fresh, _ = main.load_candles(["AAA", "BBB"], LOOKBACK, config, download=RecordingDownload())
+    # a 2:1 split adjusted upstream: the stored bars no longer match what Yahoo returns
+    doubled = main.load_stored_candles(store_dir, "AAA")
+    doubled[["Open", "High", "Low", "Close"]] *= 2
+    main.save_stored_candles(store_dir, "AAA", doubled)
+    dl = RecordingDownload()
+    frames, _ = main.load_candles(["AAA", "BBB"], LOOKBACK, config, download=dl)
+    assert (["AAA"], window_start.isoformat()) in dl.calls
+    pd.testing.assert_frame_equal(frames["AAA"], fresh["AAA"], check_freq=False)
+    pd.testing.assert_frame_equal(main.load_stored_candles(store_dir, "AAA"), fresh["AAA"], check_freq=False,
+                                  check_index_type=False)
+
+
+def test_restated_detects_changed_overlap_only():
+    df = offline.synthetic_candles("AAA", bars=30)
+    assert not main.restated(df, df.iloc[-5:].copy())
+    bumped = df.iloc[-5:].copy()
+    bumped.iloc[0, bumped.columns.get_loc("Close")] *= 1.001
+    assert main.restated(df, bumped)
+    assert main.restated(df.iloc[:10], df.iloc[-5:])  # no overlapping bars at all
+
+
+def test_store_is_trimmed_to_the_window(tmp_path):
+    config = store_config(tmp_path)
+    store_dir = config["candles"]["store_dir"]
+    window_start, _ = main.candle_window(LOOKBACK)
+    long = offline.synthetic_candles("AAA", bars=600)
+    main.save_stored_candles(store_dir, "AAA", long)
+    main.save_store_index(store_dir, {"AAA": {"start": long.index[0].date().isoformat()}})
+    frames, _ = main.load_candles(["AAA"], LOOKBACK, config, download=RecordingDownload())
+    assert frames["AAA"].index[0] >= pd.Timestamp(window_start)
+    assert np.array_equal(main.load_stored_candles(store_dir, "AAA").index, frames["AAA"].index)
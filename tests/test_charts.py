@@ -0,0 +1,39 @@
+import json
+import os
+
+import main
+import offline
+
+
+def read_manifest(out_dir):
+    with open(os.path.join(out_dir, ".chart_hashes.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_unchanged_chart_is_reused_on_a_later_day(tmp_path, capsys):
+    out_dir = str(tmp_path)
+    frames = {"AAA": offline.synthetic_candles("AAA", bars=260)}
+    main.render_charts(frames, {}, ["AAA"], out_dir, "2026-01-02", workers=1)
+    first = os.path.join(out_dir, "2026-01-02_AAA.png")
+    assert os.path.exists(first)
+    capsys.readouterr()
+
+    main.render_charts(frames, {}, ["AAA"], out_dir, "2026-01-05", workers=1)
+    assert "rendered 0, unchanged 1" in capsys.readouterr().out
+    second = os.path.join(out_dir, "2026-01-05_AAA.png")
+    assert os.path.exists(second)
+    manifest = read_manifest(out_dir)
+    assert list(manifest) == ["AAA"] and manifest["AAA"]["png"] == second
+
+
+def test_manifest_drops_charts_that_were_deleted(tmp_path, capsys):
+    out_dir = str(tmp_path)
+    frames = {t: offline.synthetic_candles(t, bars=260) for t in ("AAA", "BBB")}
+    main.render_charts(frames, {}, ["AAA", "BBB"], out_dir, "2026-01-02", workers=1)
+    os.remove(os.path.join(out_dir, "2026-01-02_BBB.png"))
+    capsys.readouterr()
+
+    main.render_charts(frames, {}, ["AAA"], out_dir, "2026-01-05", workers=1)
+    assert sorted(read_manifest(out_dir)) == ["AAA"]
+    main.render_charts(frames, {}, ["BBB"], out_dir, "2026-01-05", workers=1)
+    assert "rendered 1, unchanged 0" in capsys.readouterr().out.splitlines()[-1]
@@ -0,0 +1,45 @@
+import numpy as np
+
+import main
+import offline
+from test_backfill import live_window
+
+FACTORS = ["SPY", "QQQ", "USO", "UUP"]
+
+
+def test_matches_pairwise_pandas():
+    tickers = [f"T{i}" for i in range(12)]
+    frames = {s: offline.synthetic_candles(s, bars=250) for s in tickers + FACTORS}
+    frames["T3"] = frames["T3"].iloc[-30:]  # too short for min_obs
+    frames["T5"] = frames["T5"].drop(frames["T5"].index[-10:-7])  # halted for a few days
+    frames["USO"] = frames["USO"].drop(frames["USO"].index[-20])
+    cols = main.cross_asset_columns(frames, tickers + ["MISSING"], FACTORS, 60, 40)
+    dates = sorted(set().union(*(frames[s].index for s in tickers + FACTORS)))[-61:]
+    for i, t in enumerate(tickers):
+        for f in FACTORS:
+            a, b = frames[t]["Close"].reindex(dates), frames[f]["Close"].reindex(dates)
+            ra, rb = np.log(a / a.shift(1)).iloc[1:], np.log(b / b.shift(1)).iloc[1:]
+            both = ra.notna() & rb.notna()
+            corr, beta = cols[f"x_{f}_corr"][i], cols[f"x_{f}_beta"][i]
+            if both.sum() < 40:
+                assert np.isnan(corr) and np.isnan(beta), (t, f)
+                continue
+            assert abs(corr - ra[both].corr(rb[both])) < 1e-9, (t, f)
+            assert abs(beta - ra[both].cov(rb[both]) / rb[both].var()) < 1e-9, (t, f)
+            assert abs(cols[f"x_{f}_rs"][i] - (np.exp(ra.sum() - rb.sum()) - 1)) < 1e-9, (t, f)
+    assert all(np.isnan(cols[f"x_{f}_corr"][-1]) for f in FACTORS)
+
+
+def test_backfill_matches_live_runs():
+    tickers = ["AAPL", "MSFT", "NEWCO"]
+    frames = {s: offline.synthetic_candles(s, start="2024-01-01", end="2026-10-17") for s in tickers + FACTORS}
+    frames["NEWCO"] = frames["NEWCO"].iloc[-330:]
+    history = main.return_history(frames, tickers + FACTORS)
+    for date_str in ("2025-06-02", "2025-08-15", "2025-09-30", "2026-10-16"):
+        live = {s: live_window(frames[s], date_str) for s in tickers + FACTORS}
+        have = [t for t in tickers if len(live[t])]
+        want = main.cross_asset_columns(live, have, FACTORS)
+        got = main.cross_asset_asof(history, have, FACTORS, date_str)
+        assert set(got) == set(want)
+        for k in want:
+            assert np.allclose(got[k], want[k], rtol=1e-12, atol=0, equal_nan=True), (date_str, k)
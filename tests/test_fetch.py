@@ -0,0 +1,152 @@
+import threading
+import time
+
+import pytest
+
+import main
+import offline
+
+FAST = {"retries": 1, "backoff_sec": 0, "hedge_after_sec": 0, "breaker_failures": 50}
+
+
+@pytest.fixture(autouse=True)
+def fast_upstreams():
+    main.configure_upstreams({"fetch": {name: dict(FAST) for name in main.UPSTREAM_DEFAULTS}})
+    yield
+    main.configure_upstreams({})
+
+
+def fake_call(faults, value="ok"):
+    def fn():
+        faults.before()
+        return value
+    return fn
+
+
+def test_transient_errors_are_retried_with_backoff():
+    waits = []
+    up = main.Upstream("test", timeout_sec=5, retries=2, backoff_sec=0.1, sleep=waits.append)
+    faults = offline.Faults(fail_first=2, status=503)
+    main.TRACER.reset()
+    with main.TRACER.span("fetch"):
+        assert up.call(fake_call(faults)) == "ok"
+    assert faults.calls == 3 and len(waits) == 2
+    assert main.TRACER.summary()["fetch"]["retries"] == 2
+
+
+def test_client_errors_are_not_retried():
+    up = main.Upstream("test", timeout_sec=5, retries=3, backoff_sec=0, sleep=lambda s: None)
+    faults = offline.Faults(fail_first=1, status=404)
+    with pytest.raises(offline.FakeAPIError):
+        up.call(fake_call(faults))
+    assert faults.calls == 1
+
+
+def test_slow_call_is_hedged():
+    calls = []
+    lock = threading.Lock()
+
+    def fn():
+        with lock:
+            calls.append(1)
+            n = len(calls)
+        time.sleep(2.0 if n == 1 else 0.0)
+        return n
+
+    up = main.Upstream("test", timeout_sec=5, retries=0, hedge_after_sec=0.1)
+    t0 = time.perf_counter()
+    assert up.call(fn) == 2
+    assert time.perf_counter() - t0 < 1.0
+
+
+def test_breaker_opens_on_hangs_and_recovers_half_open():
+    up = main.Upstream("test", timeout_sec=0.1, retries=0, breaker_failures=2, breaker_reset_sec=0.3)
+    hang = offline.Faults(hang=True)
+    for _ in range(2):
+        with pytest.raises(TimeoutError):
+            up.call(fake_call(hang))
+    with pytest.raises(main.CircuitOpen):
+        up.call(fake_call(offline.Faults()))
+    assert hang.calls == 2
+    time.sleep(0.35)
+    # half-open: a single failure re-opens the circuit straight away
+    with pytest.raises(offline.FakeAPIError):
+        up.call(fake_call(offline.Faults(fail_first=1)))
+    with pytest.raises(main.CircuitOpen):
+        up.call(fake_call(offline.Faults()))
+    time.sleep(0.35)
+    assert up.call(fake_call(offline.Faults())) == "ok"
+    assert up.call(fake_call(offline.Faults())) == "ok"
+
+
+def test_candles_fall_back_to_the_store_when_yahoo_is_down(tmp_path):
+    config = {"candles": {"store_dir": str(tmp_path / "candles")}, "per_call_delay_sec": 0}
+    healthy, _ = main.load_candles(["AAA", "BBB"], 260, config, download=offline.make_download())
+    faults = offline.Faults(fail_every=1)
+    main.TRACER.reset()
+    frames, failures = main.load_candles(["AAA", "BBB"], 260, config, download=offline.make_download(faults=faults))
+    assert faults.calls == 2  # one batch, retried once
+    assert not failures
+    for s in ("AAA", "BBB"):
+        assert frames[s].attrs.get("stale")
+        assert frames[s].index[-1] == healthy[s].index[-1]
+    span = main.TRACER.summary()["yahoo_candles"]
+    assert span["retries"] == 1 and span["errors"] == 1
+
+
+def test_news_falls_back_to_cached_headlines(tmp_path):
+    cache = main.NewsCache(str(tmp_path / "news"), ttl_sec=0)
+    fresh = main.google_news_company("Example Corp", session=offline.FakeNewsSession(), cache=cache)
+    assert fresh and not any(it.get("stale") for it in fresh)
+    session = offline.FakeNewsSession(faults=offline.Faults(fail_every=1, status=503))
+    stale = main.google_news_company("Example Corp", session=session, cache=cache)
+    assert session.requests == 2
+    assert [it["title"] for it in stale] == [it["title"] for it in fresh]
+    assert all(it["stale"] for it in stale)
+    assert main.google_news_company("Uncached Corp", session=session, cache=cache) == []
+
+
+def test_recommendations_fall_back_to_the_last_stored_answer(tmp_path):
+    features = [main.build_features(t, offline.synthetic_candles(t, bars=260)) for t in ("AAA", "BBB")]
+    config = {"gemini": {"shard_size": 10, "max_retries": 0},
+              "llm_cache": {"dir": str(tmp_path / "llm_cache")}}
+    first = main.call_gemini_cached(config, {}, features, {}, model=offline.FakeModel())
+    assert [r["ticker"] for r in first["tickers"]] == ["AAA", "BBB"]
+
+    config["llm_cache"]["refresh"] = True
+    model = offline.FakeModel(faults=offline.Faults(fail_every=1))
+    again = main.call_gemini_cached(config, {}, features, {}, model=model)
+    assert model.calls == 2  # one shard, retried once by the fetch layer
+    assert [r["ticker"] for r in again["tickers"]] == ["AAA", "BBB"]
+    assert all(r["stale"] for r in again["tickers"])
+    assert [r["stance"] for r in again["tickers"]] == [r["stance"] for r in first["tickers"]]
+
+
+def test_serial_upstream_never_overlaps_a_timed_out_call():
+    running, peak = [], []
+    lock = threading.Lock()
+    release = threading.Event()
+
+    def fn(wait):
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        try:
+            if wait:
+                release.wait(5)
+            return "ok"
+        finally:
+            with lock:
+                running.pop()
+
+    up = main.Upstream("test", timeout_sec=0.1, retries=3, backoff_sec=0, hedge_after_sec=0.01,
+                       serial=True, sleep=lambda s: None)
+    with pytest.raises(TimeoutError):
+        up.call(fn, True)
+    assert len(peak) == 1  # not retried or hedged while the first call is still running
+    with pytest.raises(TimeoutError):
+        up.call(fn, False)  # waits for the abandoned call, then gives up
+    assert len(peak) == 1
+    release.set()
+    assert up.call(fn, False) == "ok"
+    assert max(peak) == 1
@@ -0,0 +1,80 @@
+import re
+
+import main
+import offline
+
+
+def features_for(tickers):
+    return [main.build_features(t, offline.synthetic_candles(t, bars=260)) for t in tickers]
+
+
+class RecordingModel(offline.FakeModel):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.sent = []
+
+    def generate_content(self, contents):
+        prompt = contents[0]["parts"][0]
+        with self.lock:
+            self.sent.append(re.findall(r"^- ([A-Za-z0-9.^=\-]+) price=", prompt, flags=re.MULTILINE))
+        return super().generate_content(contents)
+
+
+def test_only_the_malformed_shard_is_resent():
+    tickers = ["AAA", "BBB", "CCC", "DDD", "EEE", "FFF"]
+    config = {"gemini": {"shard_size": 2, "max_workers": 1, "max_retries": 2}}
+    model = RecordingModel(bad_every=3)  # the third reply (shard 3, first attempt) is truncated JSON
+    ai_json = main.call_gemini_sharded(config, {}, features_for(tickers), {}, model=model)
+    assert model.sent == [["AAA", "BBB"], ["CCC", "DDD"], ["EEE", "FFF"], ["EEE", "FFF"]]
+    assert [r["ticker"] for r in ai_json["tickers"]] == tickers
+    assert main.validate_ai_json(ai_json, tickers) == []
+
+
+def test_shard_that_never_validates_is_left_out():
+    tickers = ["AAA", "BBB", "CCC"]
+    config = {"gemini": {"shard_size": 1, "max_workers": 1, "max_retries": 1}}
+    model = RecordingModel(bad_every=2)  # BBB's shard gets the 2nd and 4th replies, both truncated
+    ai_json = main.call_gemini_sharded(config, {}, features_for(tickers), {}, model=model)
+    assert model.sent == [["AAA"], ["BBB"], ["CCC"], ["BBB"]]
+    assert [r["ticker"] for r in ai_json["tickers"]] == ["AAA", "CCC"]
+
+
+def cached_config(tmp_path, **cache):
+    return {"gemini": {"shard_size": 10, "max_workers": 1, "max_retries": 0},
+            "llm_cache": dict({"dir": str(tmp_path / "llm_cache")}, **cache)}
+
+
+def test_unchanged_tickers_are_served_from_the_cache(tmp_path, monkeypatch):
+    monkeypatch.delenv("LLM_CACHE_REFRESH", raising=False)
+    features = features_for(["AAA", "BBB", "CCC"])
+    config = cached_config(tmp_path)
+    first = main.call_gemini_cached(config, {}, features, {}, model=RecordingModel())
+    model = RecordingModel()
+    again = main.call_gemini_cached(config, {}, features, {}, model=model)
+    assert model.sent == []
+    assert again["tickers"] == first["tickers"]
+
+
+def test_changed_feature_line_is_resent(tmp_path, monkeypatch):
+    monkeypatch.delenv("LLM_CACHE_REFRESH", raising=False)
+    features = features_for(["AAA", "BBB", "CCC"])
+    config = cached_config(tmp_path)
+    main.call_gemini_cached(config, {}, features, {}, model=RecordingModel())
+    features[1] = dict(features[1], price=features[1]["price"] * 1.01)
+    model = RecordingModel()
+    again = main.call_gemini_cached(config, {}, features, {}, model=model)
+    assert model.sent == [["BBB"]]
+    assert [r["ticker"] for r in again["tickers"]] == ["AAA", "BBB", "CCC"]
+
+
+def test_refresh_resends_every_ticker(tmp_path, monkeypatch):
+    monkeypatch.delenv("LLM_CACHE_REFRESH", raising=False)
+    features = features_for(["AAA", "BBB"])
+    main.call_gemini_cached(cached_config(tmp_path), {}, features, {}, model=RecordingModel())
+    model = RecordingModel()
+    main.call_gemini_cached(cached_config(tmp_path, refresh=True), {}, features, {}, model=model)
+    assert model.sent == [["AAA", "BBB"]]
+    monkeypatch.setenv("LLM_CACHE_REFRESH", "1")
+    model = RecordingModel()
+    main.call_gemini_cached(cached_config(tmp_path), {}, features, {}, model=model)
+    assert model.sent == [["AAA", "BBB"]]
@@ -0,0 +1,8 @@
+import bench
+
+
+def test_import_main_stays_lazy_and_fast():
+    # each run is a cold `python -c "import main"` in a fresh interpreter
+    cost = bench.import_cost(repeat=3)
+    assert cost["heavy_modules_loaded"] == [], cost
+    assert cost["seconds"] < bench.IMPORT_BUDGET_SEC, cost
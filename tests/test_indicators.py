@@ -0,0 +1,76 @@
+import math
+
+import main
+import offline
+
+
+def assert_same_features(got, ref):
+    assert got is not None and ref is not None
+    assert set(got) == set(ref)
+    for k, want in ref.items():
+        have = got[k]
+        if isinstance(want, float) and math.isnan(want):
+            assert math.isnan(have), k
+        elif isinstance(want, float):
+            assert have == want or abs(have - want) <= 1e-12 * abs(want), (k, have, want)
+        else:
+            assert have == want, k
+
+
+EMA_FIELDS = ("rsi14", "macd", "macd_signal", "macd_hist")
+
+
+def assert_close_features(got, ref):
+    # the state's EMAs keep the seed of bars the store has since trimmed away
+    assert_same_features({k: v for k, v in got.items() if k not in EMA_FIELDS},
+                         {k: v for k, v in ref.items() if k not in EMA_FIELDS})
+    tol = main.IndicatorState.EMA_TOLERANCE
+    assert abs(got["rsi14"] - ref["rsi14"]) <= tol * 100
+    for k in ("macd", "macd_signal", "macd_hist"):
+        assert abs(got[k] - ref[k]) <= tol * ref["price"], (k, got[k], ref[k])
+
+
+def test_incremental_matches_full_recompute_on_sliding_windows(tmp_path):
+    # a one-year window that moves forward a bar per run, as the candle store trims it
+    df = offline.synthetic_candles("SLIDE", bars=300)
+    state_dir = str(tmp_path / "indicators")
+    for end in range(250, 301):
+        win = df.iloc[end - 250:end]
+        got = main.build_features_incremental({"SLIDE": win}, ["SLIDE"], state_dir)["SLIDE"]
+        assert_close_features(got, main.build_features("SLIDE", win))
+
+
+def test_sliding_window_updates_the_state_instead_of_rebuilding(tmp_path):
+    df = offline.synthetic_candles("SLIDE", bars=400)
+    state_dir = str(tmp_path / "indicators")
+    main.build_features_incremental({"SLIDE": df.iloc[:252]}, ["SLIDE"], state_dir)
+    for end in range(253, 401, 3):
+        win = df.iloc[end - 252:end]
+        st = main.load_indicator_state(state_dir, "SLIDE")
+        assert st.catch_up(win)
+        assert st.n == end  # every bar absorbed once, never replayed from the window
+        main.save_indicator_state(state_dir, st)
+        assert_close_features(main.load_indicator_state(state_dir, "SLIDE").features(),
+                              main.build_features("SLIDE", win))
+    assert main.load_indicator_state(state_dir, "SLIDE").n == 400
+
+
+def test_incremental_catch_up_on_growing_history(tmp_path):
+    df = offline.synthetic_candles("GROW", bars=320)
+    state_dir = str(tmp_path / "indicators")
+    main.build_features_incremental({"GROW": df.iloc[:260]}, ["GROW"], state_dir)
+    for end in range(261, 321, 7):
+        st = main.load_indicator_state(state_dir, "GROW")
+        assert st.catch_up(df.iloc[:end])
+        main.save_indicator_state(state_dir, st)
+        assert_same_features(main.load_indicator_state(state_dir, "GROW").features(),
+                             main.build_features("GROW", df.iloc[:end]))
+
+
+def test_catch_up_refuses_prepended_history_or_a_restated_frame():
+    df = offline.synthetic_candles("TRIM", bars=300)
+    st = main.IndicatorState.from_frame("TRIM", df.iloc[10:260])
+    assert not st.catch_up(df.iloc[:270])
+    restated = df.iloc[:270].copy()
+    restated.iloc[259, restated.columns.get_loc("Close")] *= 1.01
+    assert not st.catch_up(restated)
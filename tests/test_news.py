@@ -0,0 +1,48 @@
+import main
+import offline
+
+
+def test_expired_feed_is_revalidated_with_its_etag(tmp_path):
+    cache = main.NewsCache(str(tmp_path / "news"), ttl_sec=0)
+    session = offline.FakeNewsSession()
+    first = main.google_news_company("Example Corp", session=session, cache=cache)
+    key = main.NewsCache.key("Example Corp", None, 2)
+    stored = cache.get(key)
+    assert stored["etag"]
+    again = main.google_news_company("Example Corp", session=session, cache=cache)
+    assert session.requests == 2 and session.not_modified == 1
+    assert again == first
+    assert cache.get(key)["fetched_at"] >= stored["fetched_at"]
+
+
+def test_fresh_feed_is_served_without_a_request(tmp_path):
+    cache = main.NewsCache(str(tmp_path / "news"), ttl_sec=3600)
+    session = offline.FakeNewsSession()
+    first = main.google_news_company("Example Corp", session=session, cache=cache)
+    assert main.google_news_company("Example Corp", session=session, cache=cache) == first
+    assert session.requests == 1
+
+
+def test_dedupe_backfills_a_dropped_headline():
+    news_map = {
+        "AAA": [{"title": "Chips rally - Wire", "link": "https://x.com/a"},
+                {"title": "AAA beats", "link": "https://x.com/b"}],
+        "BBB": [{"title": "Chips rally - Other Wire", "link": "https://y.com/c"},
+                {"title": "BBB guides up", "link": "https://y.com/d"},
+                {"title": "BBB signs deal", "link": "https://y.com/e"}],
+    }
+    out = main.dedupe_news(news_map, limit=2)
+    assert [it["title"] for it in out["AAA"]] == ["Chips rally - Wire", "AAA beats"]
+    assert [it["title"] for it in out["BBB"]] == ["BBB guides up", "BBB signs deal"]
+
+
+def test_fetch_keeps_per_ticker_headlines_after_cross_ticker_duplicates():
+    # both feeds carry the same market headline; the second ticker gets a spare one instead
+    cfg = {"per_ticker": 3, "rate_per_sec": 1000, "burst": 1000, "cache": {"enable": False}}
+    queries = {"AAA": "Alpha Corp", "DDD": "Delta Corp"}
+    out = main.fetch_news_map(queries, cfg, session=offline.FakeNewsSession())
+    market = offline._MARKET_HEADLINES[offline._seed("Alpha Corp") % len(offline._MARKET_HEADLINES)]
+    titles = {t: [it["title"].rsplit(" - ", 1)[0] for it in items] for t, items in out.items()}
+    assert market in titles["AAA"]
+    assert market not in titles["DDD"]
+    assert len(titles["AAA"]) == len(titles["DDD"]) == 3
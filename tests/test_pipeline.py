@@ -0,0 +1,62 @@
+import os
+
+import main
+import offline
+
+
+def offline_config(tmp_path, tickers=("AAA", "BBB")):
+    config = main.load_config(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yml"))
+    work = str(tmp_path / "work")
+    config.update({
+        "offline": True,
+        "tickers": list(tickers),
+        "charts": {"enable": False},
+        "news": dict(config["news"], rate_per_sec=0, cache={"dir": os.path.join(work, "news_cache")}),
+        "candles": dict(config["candles"], store_dir=os.path.join(work, "candles")),
+        "llm_cache": dict(config["llm_cache"], dir=os.path.join(work, "llm_cache")),
+        "pipeline": dict(config["pipeline"], stage_dir=os.path.join(work, "stages"), max_workers=2),
+        "fetch": {k: dict(v, retries=0, backoff_sec=0) for k, v in config["fetch"].items()},
+    })
+    return config
+
+
+def test_degraded_stage_outputs_are_not_cached(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = offline_config(tmp_path)
+    now = main.datetime.now(main.ZoneInfo(config["timezone"]))
+    cache_dir = os.path.join(config["pipeline"]["stage_dir"], now.strftime("%Y-%m-%d"))
+
+    # first run: Gemini is down and nothing is in the LLM cache yet, so the report has no recommendations
+    monkeypatch.setattr(main, "llm_model", lambda c: offline.FakeModel(faults=offline.Faults(fail_every=1)))
+    status = main.run_daily(config, now)
+    assert status["report"] == "done"
+    assert os.path.exists(os.path.join(cache_dir, "candles.pkl"))
+    assert not os.path.exists(os.path.join(cache_dir, "llm.pkl"))
+
+    # a resumed run asks the model again instead of replaying the empty answer
+    model = offline.FakeModel()
+    monkeypatch.setattr(main, "llm_model", lambda c: model)
+    main.run_daily(config, now, resume=True)
+    assert model.calls == 1
+    assert os.path.exists(os.path.join(cache_dir, "llm.pkl"))
+
+
+def busy_stage_a():
+    return sum(range(1000))
+
+
+def busy_stage_b(a):
+    return a + sum(range(1000))
+
+
+def test_profiled_stages_are_merged_across_threads():
+    profiles = []
+    stages = [main.Stage("a", busy_stage_a, (), cache=False),
+              main.Stage("b", busy_stage_b, ("a",), cache=False)]
+    results, status = main.run_stages(stages, workers=4, profiles=profiles)
+    assert status == {"a": "done", "b": "done"} and results["b"] == 2 * sum(range(1000))
+    assert len(profiles) == 2
+    stats = main.pstats.Stats(profiles[0])
+    stats.add(profiles[1])
+    profiled = {func for _, _, func in stats.stats}
+    assert {"busy_stage_a", "busy_stage_b"} <= profiled
@@ -0,0 +1,79 @@
+import os
+import re
+
+import numpy as np
+
+import main
+import offline
+from test_pipeline import offline_config
+
+TICKERS = [f"S{i:02d}" for i in range(30)]
+
+
+def universe():
+    frames = {t: offline.synthetic_candles(t, bars=260) for t in TICKERS}
+    return frames, main.build_features_panel(frames, TICKERS)
+
+
+def test_top_k_matches_a_full_sort():
+    frames, table = universe()
+    cfg = {"top_k": 7}
+    selected, scores = main.screen_top_k(table, frames, cfg)
+    raw = main.screen_scores(table, frames)
+    assert len(selected) == 7
+    assert selected == [t for t in TICKERS if t in set(selected)]  # watchlist order
+    ranked = np.sort(raw)[::-1]
+    assert sorted(raw[[TICKERS.index(t) for t in selected]], reverse=True) == list(ranked[:7])
+    assert set(scores) == set(TICKERS)
+
+
+def test_always_tickers_are_kept():
+    frames, table = universe()
+    raw = main.screen_scores(table, frames)
+    weakest = TICKERS[int(np.argmin(raw))]
+    selected, _ = main.screen_top_k(table, frames, {"top_k": 3, "always": [weakest, "NOT_LISTED"]})
+    assert weakest in selected and len(selected) == 4
+
+
+def test_screened_out_tickers_are_labelled_and_left_out_of_the_details():
+    frames, table = universe()
+    features = table.select(TICKERS[:3])
+    ai_json = {"tickers": [{"ticker": TICKERS[0], "stance": "Buy", "confidence": 70}]}
+    out = TICKERS[1:3]
+    md = main.render_report("2026-01-02", {}, features, ai_json, {}, screened_out=out)
+    for t in out:
+        row = next(l for l in md.splitlines() if l.startswith(f"| `{t}`"))
+        assert "| screened out |" in row
+        assert f"### {t}" not in md
+    assert f"### {TICKERS[0]}" in md
+    rows = main.sheet_rows("2026-01-02", features, ai_json, screened_out=out)
+    assert [r[3] for r in rows] == ["Buy", "screened out", "screened out"]
+
+
+class PromptRecordingModel(offline.FakeModel):
+    def __init__(self, sent):
+        super().__init__()
+        self.sent = sent
+
+    def generate_content(self, contents):
+        prompt = contents[0]["parts"][0]
+        with self.lock:
+            self.sent.extend(re.findall(r"^- ([A-Za-z0-9.^=\-]+) price=", prompt, flags=re.MULTILINE))
+        return super().generate_content(contents)
+
+
+def test_only_selected_tickers_reach_the_prompt(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("LLM_CACHE_REFRESH", raising=False)
+    config = offline_config(tmp_path, tickers=TICKERS[:8])
+    config["screen"] = dict(config["screen"], top_k=3, always=[])
+    sent = []
+    monkeypatch.setattr(main, "llm_model", lambda c: PromptRecordingModel(sent))
+    now = main.datetime.now(main.ZoneInfo(config["timezone"]))
+    status = main.run_daily(config, now)
+    assert status["report"] == "done"
+    assert len(sent) == 3
+    with open(os.path.join("reports", now.strftime("%Y-%m-%d") + ".md"), encoding="utf-8") as f:
+        md = f.read()
+    assert md.count("| screened out |") == 5
+    assert all(f"### {t}" in md for t in sent)
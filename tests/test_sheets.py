@@ -0,0 +1,66 @@
+import pytest
+
+import main
+import offline
+
+HEADER = ["date", "ticker", "price", "stance", "confidence", "rsi14", "sma50", "positive", "negative"]
+NO_WAIT = {"backoff_sec": 0}
+
+
+class RecordingWorksheet(offline.FakeWorksheet):
+    def __init__(self, rows=None, quota_every=0):
+        super().__init__(rows, quota_every)
+        self.batches = []
+
+    def batch_update(self, data, **kwargs):
+        super().batch_update(data, **kwargs)
+        self.batches.append([d["range"] for d in data])
+
+
+def rows_for(date_str, tickers, price=100.0):
+    return [[date_str, t, price, "Hold", 50, 55.0, 99.0, "-", "-"] for t in tickers]
+
+
+def test_rerun_is_idempotent():
+    ws = offline.FakeWorksheet([HEADER])
+    rows = rows_for("2026-10-15", ["AAA", "BBB"]) + rows_for("2026-10-16", ["AAA", "BBB"])
+    assert main.write_sheet_rows(ws, rows, NO_WAIT) == {"updated": 0, "inserted": 4}
+    first = ws.get_all_values()
+    assert main.write_sheet_rows(ws, rows, NO_WAIT) == {"updated": 4, "inserted": 0}
+    assert ws.get_all_values() == first
+
+
+def test_updates_merge_into_ranges_and_inserts_append():
+    ws = RecordingWorksheet([HEADER] + rows_for("2026-10-15", ["AAA", "BBB", "CCC"])
+                            + rows_for("2026-10-16", ["AAA", "BBB", "CCC"]))
+    rows = rows_for("2026-10-15", ["AAA", "BBB", "CCC"], 101.0) + rows_for("2026-10-16", ["CCC", "DDD"], 102.0)
+    assert main.write_sheet_rows(ws, rows, NO_WAIT) == {"updated": 4, "inserted": 1}
+    assert ws.batches == [["A2:I4", "A7:I7"]]
+    values = ws.get_all_values()
+    assert [r[2] for r in values[1:]] == ["101.0", "101.0", "101.0", "100.0", "100.0", "102.0", "102.0"]
+    assert values[-1][:2] == ["2026-10-16", "DDD"]
+
+
+def test_chunking_splits_ranges_and_requests():
+    ws = RecordingWorksheet([HEADER] + rows_for("2026-10-15", ["AAA", "BBB", "CCC"]))
+    main.upsert_rows(ws, rows_for("2026-10-15", ["AAA", "BBB", "CCC"], 101.0), chunk_rows=2, sleep=lambda s: None)
+    assert ws.batches == [["A2:I3"], ["A4:I4"]]
+
+
+def test_quota_errors_back_off_and_retry():
+    ws = offline.FakeWorksheet([HEADER], quota_every=2)
+    waits = []
+    rows = rows_for("2026-10-15", ["AAA", "BBB", "CCC"])
+    main.upsert_rows(ws, rows, chunk_rows=1, retries=3, backoff_sec=0.5, sleep=waits.append)
+    assert ws.quota_errors == len(waits) > 0
+    assert all(w > 0 for w in waits)
+    ws.quota_every = 0
+    assert [r[1] for r in ws.get_all_values()[1:]] == ["AAA", "BBB", "CCC"]
+
+
+def test_quota_errors_give_up_after_max_retries():
+    ws = offline.FakeWorksheet([HEADER], quota_every=1)
+    waits = []
+    with pytest.raises(offline.FakeAPIError):
+        main.upsert_rows(ws, rows_for("2026-10-15", ["AAA"]), retries=2, sleep=waits.append)
+    assert len(waits) == 2
@@ -0,0 +1,20 @@
+import math
+
+import main
+import offline
+
+
+def one_year_table():
+    frames = {"AAA": offline.synthetic_candles("AAA", bars=252)}
+    return main.build_features_panel(frames, ["AAA"], main.resample_bars(frames, ["AAA"]))
+
+
+def test_monthly_macd_needs_enough_bars():
+    f = one_year_table().row(0)
+    assert not math.isnan(f["wk_macd"])
+    assert all(math.isnan(f[f"mo_{k}"]) for k in ("macd", "macd_signal", "macd_hist", "sma20", "rsi14"))
+    assert not math.isnan(f["mo_chg"])
+    assert "MACD=" in main.timeframe_text(f, "wk")
+    text = main.timeframe_text(f, "mo")
+    assert text.startswith("chg=") and "MACD" not in text and "Bearish" not in text and "Bullish" not in text
+    assert "M: chg=" in main.feature_line(f)